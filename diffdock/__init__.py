@@ -30,10 +30,13 @@ This package contains protocols for creating and using ConPLex models for virtua
 """
 
 # General imports
-import os, subprocess, json
+import os, subprocess, json, tempfile, time, secrets, threading, fcntl
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client
 
 # Scipion em imports
 import pwem
+import pyworkflow
 from scipion.install.funcs import InstallHelper
 
 # Plugin imports
@@ -48,10 +51,18 @@ class Plugin(pwchemPlugin):
 	"""
 	"""
 	_dfdHome = os.path.join(pwem.Config.EM_ROOT, DIFFDOCK_DIC['name'] + '-' + DIFFDOCK_DIC['version'])
+	_dfdCPUHome = os.path.join(pwem.Config.EM_ROOT, DIFFDOCK_CPU_DIC['name'] + '-' + DIFFDOCK_CPU_DIC['version'])
+	# Serialises the worker startup among the threads of this process (a file lock does it among processes)
+	_workerLock = threading.Lock()
 
 	@classmethod
 	def _defineVariables(cls):
 		cls._defineEmVar(DIFFDOCK_DIC['home'], cls._dfdHome)
+		cls._defineEmVar(DIFFDOCK_CPU_DIC['home'], cls._dfdCPUHome)
+		# The caches are written by the protocols, so they default to the user data, as the EM_ROOT of a shared
+		# installation is usually read-only
+		cls._defineVar(DIFFDOCK_CACHE_VAR, os.path.join(pyworkflow.Config.SCIPION_USER_DATA, 'DiffDock-cache'))
+		cls._defineVar(DIFFDOCK_INFERENCE_VAR, '')
 
 	@classmethod
 	def defineBinaries(cls, env):
@@ -59,30 +70,123 @@ class Plugin(pwchemPlugin):
         This function defines the binaries for each package.
         """
 		cls.addDiffDockPackage(env)
+		cls.addDiffDockPackage(env, default=False, cpuOnly=True)
 
 	@classmethod
-	def addDiffDockPackage(cls, env, default=True):
-		""" This function provides the neccessary commands for installing AutoDock. """
+	def addDiffDockPackage(cls, env, default=True, cpuOnly=False):
+		""" This function provides the neccessary commands for installing DiffDock.
+		If cpuOnly, it installs a conda environment with the CPU builds of torch, for nodes without GPUs,
+		which runs the code of the DiffDock package. """
+		packageDic = DIFFDOCK_CPU_DIC if cpuOnly else DIFFDOCK_DIC
+		torchPackages, wheelsTag = ('cpuonly -c pytorch', 'cpu') if cpuOnly else \
+			('pytorch-cuda=11.7 -c pytorch -c nvidia', 'cu117')
 		# Instantiating the install helper
-		installer = InstallHelper(DIFFDOCK_DIC['name'], packageHome=cls.getVar(DIFFDOCK_DIC['home']),
-															packageVersion=DIFFDOCK_DIC['version'])
+		installer = InstallHelper(packageDic['name'], packageHome=cls.getVar(packageDic['home']),
+															packageVersion=packageDic['version'])
 
 		# Installing package
-		installer.getCloneCommand('https://github.com/gcorso/DiffDock.git', targeName='DIFFDOCK_CLONED') \
-			.getCondaEnvCommand(pythonVersion='3.9', requirementsFile=False) \
-			.addCommand(f'{cls.getEnvActivationCommand(DIFFDOCK_DIC)} && '
-									f'conda install -y pytorch==1.11.0 pytorch-cuda=11.7 -c pytorch -c nvidia', 'PYTORCH_INSTALLED')\
-			.addCommand(f'{cls.getEnvActivationCommand(DIFFDOCK_DIC)} && '
+		if not cpuOnly:
+			installer.getCloneCommand('https://github.com/gcorso/DiffDock.git', targeName='DIFFDOCK_CLONED')
+		installer.getCondaEnvCommand(pythonVersion='3.9', requirementsFile=False) \
+			.addCommand(f'{cls.getEnvActivationCommand(packageDic)} && '
+									f'conda install -y pytorch==1.11.0 {torchPackages}', 'PYTORCH_INSTALLED')\
+			.addCommand(f'{cls.getEnvActivationCommand(packageDic)} && '
 									f'pip install torch-scatter torch-sparse==0.6.14 torch-cluster torch-spline-conv torch-geometric==2.0.4 '
-									f'-f https://data.pyg.org/whl/torch-1.11.0+cu117.html && '
+									f'-f https://data.pyg.org/whl/torch-1.11.0+{wheelsTag}.html && '
 									f'python -m pip install PyYAML scipy "networkx[default]" '
 									f'biopython rdkit-pypi e3nn spyrmsd pandas biopandas', 'DIFFDOCK_INSTALLED') \
-			.addCommand(f'{cls.getEnvActivationCommand(DIFFDOCK_DIC)} && '
+			.addCommand(f'{cls.getEnvActivationCommand(packageDic)} && '
 									f'pip install fair-esm && pip install git+https://github.com/facebookresearch/esm.git', 'ESM_INSTALLED') \
-			.addPackage(env, ['git', 'conda', 'pip'], default=default)
+			.addPackage(env, ['conda', 'pip'] if cpuOnly else ['git', 'conda', 'pip'], default=default)
 
 
 	# ---------------------------------- Protocol functions-----------------------
 	@classmethod
 	def getPackageDir(cls, path=''):
 		return os.path.abspath(os.path.join(cls.getVar(DIFFDOCK_DIC['home']), path))
+
+	@classmethod
+	def getCacheDir(cls, path=''):
+		return os.path.abspath(os.path.join(cls.getVar(DIFFDOCK_CACHE_VAR), path))
+
+
+	@classmethod
+	def getScriptsDir(cls, scriptName=''):
+		return os.path.join(os.path.dirname(__file__), 'scripts', scriptName)
+
+	# ---------------------------------- Inference worker -----------------------
+	@classmethod
+	def getWorkerAddress(cls):
+		""" Returns the path of the unix socket the persistent inference worker listens on. """
+		return os.path.join(tempfile.gettempdir(), f'scipion-diffdock-{os.getuid()}.sock')
+
+	@classmethod
+	def _getWorkerAuthkey(cls):
+		with open(cls.getWorkerAddress() + '.key', 'rb') as f:
+			return f.read()
+
+	@classmethod
+	def sendToWorker(cls, request):
+		""" Sends a request to the inference worker and returns its answer. Raises an OSError if not reachable. """
+		try:
+			with Client(cls.getWorkerAddress(), family='AF_UNIX', authkey=cls._getWorkerAuthkey()) as con:
+				con.send(request)
+				return con.recv()
+		except (EOFError, ConnectionError, FileNotFoundError, AuthenticationError) as e:
+			raise OSError(f'DiffDock inference worker not reachable: {e}')
+
+	@classmethod
+	def isWorkerRunning(cls):
+		try:
+			return cls.sendToWorker({'command': 'ping'})['returncode'] == 0
+		except OSError:
+			return False
+
+	@classmethod
+	def startInferenceWorker(cls, timeout=600):
+		""" Starts the persistent inference worker, if not running, and waits until it is ready to accept requests.
+		Returns whether the worker is available. Only one worker is started at a time, so the parallel steps
+		(or protocols) asking for it at the same time use the same worker. """
+		if cls.isWorkerRunning():
+			return True
+
+		address = cls.getWorkerAddress()
+		with cls._workerLock, open(address + '.lock', 'w') as lockFile:
+			fcntl.flock(lockFile, fcntl.LOCK_EX)
+			# It may have been started while waiting for the lock
+			if cls.isWorkerRunning():
+				return True
+			return cls._launchWorker(address, timeout)
+
+	@classmethod
+	def _launchWorker(cls, address, timeout):
+		fd = os.open(address + '.key', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+		with os.fdopen(fd, 'wb') as f:
+			f.write(secrets.token_bytes(32))
+
+		command = f'{cls.getEnvActivationCommand(DIFFDOCK_DIC)} && ' \
+							f'python {cls.getScriptsDir("diffdock_worker.py")} --address {address} --authkeyFile {address}.key'
+		with open(address + '.log', 'w') as log:
+			subprocess.Popen(command, shell=True, cwd=cls.getPackageDir('DiffDock'), stdout=log, stderr=subprocess.STDOUT,
+											 start_new_session=True, executable='/bin/bash')
+
+		start = time.time()
+		while time.time() - start < timeout:
+			if cls.isWorkerRunning():
+				return True
+			time.sleep(2)
+		return False
+
+	@classmethod
+	def stopInferenceWorker(cls):
+		try:
+			cls.sendToWorker({'command': 'stop'})
+		except OSError:
+			pass
+
+	@classmethod
+	def runInferenceInWorker(cls, argv, logFile, esmCacheDir=None, receptorCacheDir=None):
+		""" Runs a DiffDock inference with the given command line arguments in the worker. Returns its exit code. """
+		request = {'command': 'inference', 'argv': argv, 'logFile': os.path.abspath(logFile),
+							 'esmCacheDir': esmCacheDir, 'receptorCacheDir': receptorCacheDir}
+		return cls.sendToWorker(request)['returncode']
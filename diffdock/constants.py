@@ -30,3 +30,10 @@ DEFAULT_VERSION = '1.0'
 
 # Package dictionaries
 DIFFDOCK_DIC =  {'name': 'DiffDock',    'version': '1.0',         'home': 'DIFFDOCK_HOME'}
+# CPU-only environment, running the code of the DiffDock package
+DIFFDOCK_CPU_DIC =  {'name': 'DiffDock-cpu',    'version': '1.0',         'home': 'DIFFDOCK_CPU_HOME'}
+
+# Plugin variables
+DIFFDOCK_CACHE_VAR = 'DIFFDOCK_CACHE'
+# Command run instead of the DiffDock inference (e.g: the stub inference script), to test the pipeline without DiffDock
+DIFFDOCK_INFERENCE_VAR = 'DIFFDOCK_INFERENCE_PROGRAM'
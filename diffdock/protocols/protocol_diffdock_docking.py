@@ -24,10 +24,13 @@
 # *
 # **************************************************************************
 
-import os
+import contextlib, functools, itertools, json, math, os, shlex, shutil, threading
+from concurrent.futures import ThreadPoolExecutor
 
 from pwem.protocols import EMProtocol
+from pwem.objects import SetOfAtomStructs
 from pyworkflow.protocol import params
+from pyworkflow.protocol.constants import STATUS_NEW
 import pyworkflow.object as pwobj
 
 from pwchem import Plugin as pwchemPlugin
@@ -36,7 +39,24 @@ from pwchem.objects import SetOfSmallMolecules, SmallMolecule
 from pwchem.utils import getBaseName, pdbqt2other
 
 from .. import Plugin as diffdockPlugin
-from ..constants import DIFFDOCK_DIC
+from ..constants import DIFFDOCK_DIC, DIFFDOCK_CPU_DIC, DIFFDOCK_INFERENCE_VAR
+from ..utils import splitInShards, writeInputCSV, mergeShardOutputs, moveComplexDir, linkOrCopy, indexOutputDocks, \
+  indexComplexDir, writeManifest, indexManifest, readManifestPoses, filterPoses, packPoses, appendPoses, \
+  countHeavyAtoms, getAvailableMemory, estimateBatchSize, isOutOfMemoryLog, getLoggedArgs, getComplexName, \
+  cropStructure, PoseCache, SmilesCache, getCacheKey, getFileHash, measureResources, appendMetrics, readMetrics, \
+  parseInferenceLog, summarizeMetrics, LocalJobArray, QueueJobArray, clusterPoseIndex, iterSmilesLibrary, \
+  cleanReceptorPDB, splitThreads, getThreadsEnviron, PoseSummary
+
+# Number of molecules read at once from a library file
+LIBRARY_CHUNK_SIZE = 10000
+
+def measuredStep(stepFunc):
+  '''Decorates a protocol step so its time and memory usage are recorded in the protocol metrics file'''
+  @functools.wraps(stepFunc)
+  def measured(self, *args):
+    with measureResources(self.getStepMetricsFile(), stepFunc.__name__, args):
+      return stepFunc(self, *args)
+  return measured
 
 class ProtDiffDockDocking(EMProtocol):
   """Run a prediction using a ConPLex trained model over a set of proteins and ligands"""
@@ -45,16 +65,56 @@ class ProtDiffDockDocking(EMProtocol):
   def __init__(self, **kwargs):
     EMProtocol.__init__(self, **kwargs)
     self.stepsExecutionMode = params.STEPS_PARALLEL
+    self.cacheHits, self.cacheMisses = pwobj.Integer(), pwobj.Integer()
+    self.nFailed, self.nDuplicates = pwobj.Integer(), pwobj.Integer()
+    self.nRefined, self.nInputMols = pwobj.Integer(), pwobj.Integer()
+    self.shardMemory = pwobj.Float()
+    self._outputLock = threading.Lock()
 
   def _defineParams(self, form):
     form.addSection(label='Input')
     iGroup = form.addGroup('Input')
-    iGroup.addParam('inputAtomStruct', params.PointerParam, pointerClass="AtomStruct",
-                    label='Input atomic structure: ',
-                    help="The atomic structure to use as receptor in the docking")
+    iGroup.addParam('inputAtomStruct', params.PointerParam, pointerClass="AtomStruct, SetOfAtomStructs",
+                    label='Input atomic structure(s): ',
+                    help="The atomic structure to use as receptor in the docking. If a set of structures is input "
+                         "(e.g: an ensemble of conformations), every ligand is docked on each of them in the same run "
+                         "and the output poses store the id of their receptor")
+    iGroup.addParam('inputPockets', params.PointerParam, pointerClass="SetOfStructROIs", allowsNull=True,
+                    label='Input pockets (optional): ',
+                    help='Structural regions of interest of the receptor to restrict the docking to. For each of them, '
+                         'the receptor is cropped to the residues around it and the ligands are docked on the cropped '
+                         'structure, which is faster and lighter for big receptors. The pocket id is stored as the '
+                         'grid id of the output poses, which keep the coordinates frame of the whole receptor.\n'
+                         'Note that the ESM embeddings are computed over the sequences of the cropped receptor')
+    iGroup.addParam('pocketMargin', params.FloatParam, label='Pocket margin (A): ', default=10.0,
+                    condition='inputPockets', expertLevel=params.LEVEL_ADVANCED,
+                    help='Residues with any atom closer to the pocket center than the pocket radius plus this margin '
+                         'are kept in the cropped receptor')
+    iGroup.addParam('useLibrary', params.BooleanParam, label='Input a SMILES library file: ', default=False,
+                    help='Read the ligands directly from a SMILES or csv library file instead of a set of small '
+                         'molecules, so big libraries do not need to be imported as one file per molecule. '
+                         'Only the docked molecules with output poses are created as small molecules')
     iGroup.addParam('inputSmallMols', params.PointerParam, pointerClass="SetOfSmallMolecules",
-                    label='Input small molecules: ',
+                    label='Input small molecules: ', condition='not useLibrary',
                     help='Set of small molecules to input the model for predicting their interactions')
+    iGroup.addParam('inputLibrary', params.PathParam, label='Input SMILES library: ', condition='useLibrary',
+                    help='Library of molecules to dock. It can be a SMILES file, with the SMILES and the (optional) '
+                         'name of a molecule per line, or a csv file with a header containing a SMILES column and an '
+                         'optional name column (name, title, id...). Files compressed with gzip, bzip2 or xz '
+                         '(.gz, .bz2, .xz) are read directly.\n'
+                         'The molecules are not converted to canonical SMILES, so only identical SMILES strings are '
+                         'considered duplicated')
+    iGroup.addParam('deduplicate', params.BooleanParam, label='Dock identical molecules once: ', default=True,
+                    expertLevel=params.LEVEL_ADVANCED,
+                    help='Molecules with the same canonical SMILES (e.g: the same compound under different names) '
+                         'are docked only once, and the resulting poses are assigned to each of them')
+    iGroup.addParam('incremental', params.BooleanParam, label='Dock only new molecules: ', default=False,
+                    condition='not useLibrary', expertLevel=params.LEVEL_ADVANCED,
+                    help='When the protocol is continued after the input set grew, only the molecules whose canonical '
+                         'SMILES were not docked yet are docked, and their poses are appended to the existing output '
+                         'set. The receptors, models and docking parameters must not change between executions.\n'
+                         'If the input set is still being filled (streaming), the new molecules are docked in rounds '
+                         'as they arrive, until the input set is closed')
 
     mGroup = form.addGroup('Model', expertLevel=params.LEVEL_ADVANCED)
     mGroup.addParam('scoreModel', params.PathParam, label='Score model (pt): ', default='',
@@ -70,42 +130,839 @@ class ProtDiffDockDocking(EMProtocol):
     pGroup.addParam('inferSteps', params.IntParam, label='Inference steps: ', default=20,
                    help='Number of denoising steps')
 
+    pGroup.addParam('progressive', params.BooleanParam, label='Progressive docking: ', default=False,
+                    help='Dock the library in two stages. First, every ligand is docked with a few positions and '
+                         'inference steps. Then, only the top fraction of the ligands by their best confidence is '
+                         'docked again with the full number of positions and steps. The rest of the ligands keep '
+                         'the poses of the first stage in the output')
+    pGroup.addParam('coarseSamples', params.IntParam, label='First stage positions: ', default=5,
+                    condition='progressive', help='Number of positions generated for each ligand in the first stage')
+    pGroup.addParam('coarseSteps', params.IntParam, label='First stage inference steps: ', default=10,
+                    condition='progressive', help='Number of denoising steps in the first stage')
+    pGroup.addParam('refineFraction', params.FloatParam, label='Fraction of ligands to refine: ', default=0.1,
+                    condition='progressive',
+                    help='Fraction (0-1] of the docked ligands, the ones with the highest confidence in the first '
+                         'stage, to dock again with the full settings')
+
+    pGroup.addParam('autoBatchSize', params.BooleanParam, label='Automatic batch size: ', default=False,
+                    expertLevel=params.LEVEL_ADVANCED,
+                    help='Estimate the batch size from the available GPU (or RAM) memory and the size of the ligands. '
+                         'In any mode, if the inference runs out of memory, the pending ligands of the shard are '
+                         'docked again with half the batch size')
     pGroup.addParam('batchSize', params.IntParam, label='Batch size: ', default=10, expertLevel=params.LEVEL_ADVANCED,
-                    help='Batch size for the model')
+                    condition='not autoBatchSize', help='Batch size for the model')
     pGroup.addParam('finalDenoise', params.BooleanParam, label='Final step denoise: ', default=False,
                     expertLevel=params.LEVEL_ADVANCED,
                     help='Whether to use no noise in the final step of the reverse diffusion')
+    pGroup.addParam('cacheESM', params.BooleanParam, label='Reuse receptor ESM embeddings: ', default=True,
+                    expertLevel=params.LEVEL_ADVANCED,
+                    help='Compute the ESM language model embeddings of the receptor chains once, before docking, '
+                         'and store them by sequence so they are reused by every ligand and by later runs on the '
+                         'same receptor, instead of being computed for each complex')
+    pGroup.addParam('useWorker', params.BooleanParam, label='Use persistent inference worker: ', default=False,
+                    expertLevel=params.LEVEL_ADVANCED,
+                    help='Run the inference in a persistent DiffDock process that keeps the models loaded between '
+                         'runs, saving the environment activation, imports and checkpoint loading of each execution. '
+                         'The worker is started if it is not running and serves the requests one at a time. '
+                         'If it cannot be started, a new DiffDock process is launched as usual. '
+                         'The worker runs on the GPU, so it is not used in CPU execution')
+    pGroup.addParam('cpuMode', params.BooleanParam, label='CPU execution: ', default=False,
+                    expertLevel=params.LEVEL_ADVANCED,
+                    help='Run the inference on CPU, for nodes without GPUs. The threads of the protocol are split '
+                         'among the inference processes running at the same time, and the torch, OpenMP and MKL '
+                         'threads of each process are limited to its share, so they do not oversubscribe the cores')
+    pGroup.addParam('cpuProcesses', params.IntParam, label='Concurrent inference processes: ', default=0,
+                    condition='cpuMode', expertLevel=params.LEVEL_ADVANCED,
+                    help='Number of inference processes running at the same time, each using the protocol threads '
+                         'divided by this number. Fewer processes with more threads use less memory.\n'
+                         'If 0, one single-threaded process is run per protocol thread')
+    pGroup.addParam('cpuEnv', params.BooleanParam, label='Use CPU-only environment: ', default=False,
+                    condition='cpuMode', expertLevel=params.LEVEL_ADVANCED,
+                    help=f'Run the inference in the environment with the CPU builds of torch, which must be '
+                         f'installed as the {DIFFDOCK_CPU_DIC["name"]} package. The persistent worker is not used '
+                         f'with this environment')
+    pGroup.addParam('useJobArray', params.BooleanParam, label='Run shards as a job array: ', default=False,
+                    expertLevel=params.LEVEL_ADVANCED,
+                    help='Split the library in a number of shards independent of the protocol threads and run their '
+                         'inference as the tasks of a job array. If the protocol uses a queue, the tasks are '
+                         'submitted to the queue system of the host (as a single SLURM job array, or one job per '
+                         'task in other systems). Otherwise, they are run in a pool of as many local processes as '
+                         'threads. The shards outputs are merged when all the tasks finish.\n'
+                         'Note that the automatic batch size is estimated with the memory of the protocol host')
+    pGroup.addParam('nArrayTasks', params.IntParam, label='Number of array tasks: ', default=10,
+                    condition='useJobArray', expertLevel=params.LEVEL_ADVANCED,
+                    help='Number of shards the library is split into, each docked by a task of the job array')
+    pGroup.addParam('streamOutput', params.BooleanParam, label='Stream output poses: ', default=False,
+                    expertLevel=params.LEVEL_ADVANCED,
+                    help='Register the poses of each ligand in the output set as soon as they are complete, while '
+                         'the rest of the library is still being docked, so downstream protocols can start working. '
+                         'The output set is closed when the docking finishes')
+    pGroup.addParam('resumeDocking', params.BooleanParam, label='Resume previous docking: ', default=True,
+                    expertLevel=params.LEVEL_ADVANCED,
+                    help='When the protocol is continued after a failure, only dock the ligands whose output '
+                         'is not complete yet (the expected number of ranked poses was not found)')
+
+    fGroup = form.addGroup('Pose filtering')
+    fGroup.addParam('keepTopK', params.IntParam, label='Keep top poses per ligand: ', default=0,
+                    help='Number of best ranked poses of each ligand to register in the output. If 0, all the '
+                         'generated positions are kept')
+    fGroup.addParam('minConfidence', params.FloatParam, label='Minimum confidence: ', allowsNull=True,
+                    help='Poses with a DiffDock confidence lower than this value are not registered in the output. '
+                         'If empty, no confidence filter is applied')
+    fGroup.addParam('clusterPoses', params.BooleanParam, label='Collapse redundant poses: ', default=False,
+                    help='Cluster the poses of each ligand by their RMSD (without superposition and considering the '
+                         'symmetry of the molecule) and keep only the highest confidence pose of each cluster, so '
+                         'near-duplicated samples are not registered and rescored downstream. The clustering is done '
+                         'before the top poses and confidence filters, in parallel with the protocol threads')
+    fGroup.addParam('clusterRMSD', params.FloatParam, label='Clustering RMSD (A): ', default=2.0,
+                    condition='clusterPoses',
+                    help='Poses closer than this RMSD to a higher confidence pose are considered redundant')
+    fGroup.addParam('packOutput', params.BooleanParam, label='Pack poses in a single file: ', default=False,
+                    expertLevel=params.LEVEL_ADVANCED,
+                    help='Store all the output poses as records of a single multi-record sdf file instead of one file '
+                         'per pose in a directory per ligand, which is much lighter for shared filesystems. '
+                         'The pose file of each output molecule is the packed file, and the position of its record is '
+                         'stored in the _poseOffset attribute')
+    fGroup.addParam('deletePruned', params.BooleanParam, label='Delete filtered pose files: ', default=False,
+                    expertLevel=params.LEVEL_ADVANCED,
+                    help='Remove the sdf files of the poses discarded by the filters to save disk space')
+
+    cGroup = form.addGroup('Cache', expertLevel=params.LEVEL_ADVANCED)
+    cGroup.addParam('cacheSMILES', params.BooleanParam, label='Reuse ligand conversions: ', default=True,
+                    help='Store the canonical SMILES of the input molecule files, by file content, so repeated '
+                         'screens of the same library skip the conversion to SMILES')
+    cGroup.addParam('cacheReceptor', params.BooleanParam, label='Reuse prepared receptors: ', default=True,
+                    help='Store the prepared receptors (converted and cleaned pdb files and their parsed '
+                         'structures) by the content of the input file, so later runs on the same receptor skip its '
+                         'conversion and parsing')
+    cGroup.addParam('useCache', params.BooleanParam, label='Use pose cache: ', default=False,
+                    help='Reuse the poses of previous runs docking the same ligand (SMILES) on the same receptor file '
+                         'with the same models and prediction parameters. Only the ligands not found in the cache '
+                         'are docked, and their results are stored in it')
+    cGroup.addParam('cacheDir', params.PathParam, label='Cache directory: ', default='', condition='useCache',
+                    help=f'Directory where the pose cache is stored.\nIf None, {diffdockPlugin.getCacheDir()} '
+                         f'will be used')
+    cGroup.addParam('cacheMaxSize', params.FloatParam, label='Cache size limit (GB): ', default=10,
+                    condition='useCache',
+                    help='Maximum size of the pose cache. When exceeded, the least recently used entries are removed.'
+                         '\nIf 0, the cache size is not limited')
+
+    form.addParallelSection(threads=4, mpi=1)
 
   def _insertAllSteps(self):
-    self._insertFunctionStep(self.convertStep)
-    self._insertFunctionStep(self.predictStep)
-    self._insertFunctionStep(self.createOutputStep)
+    dSteps = self.insertDockingSteps()
+    self._insertFunctionStep(self.createOutputStep, prerequisites=dSteps, wait=self.isInputStreaming())
 
+  def insertDockingSteps(self):
+    '''Inserts the steps docking the input molecules that are not docked yet, from their conversion to the merge of
+    their poses. When the input is streamed, the poses are also registered at the end of each docking round'''
+    if not self.useLibrary.get():
+      with self.openInputMols() as inputMols:
+        self.nInputMols.set(len(inputMols))
+    cStep = self._insertFunctionStep(self.convertStep, self.nInputMols.get(), prerequisites=[])
+    if self.useCache.get():
+      cStep = self._insertFunctionStep(self.cacheLookupStep, prerequisites=[cStep])
+    if self.cacheESM.get():
+      cStep = self._insertFunctionStep(self.embeddingStep, prerequisites=[cStep])
+    if self.progressive.get():
+      coarseSteps = self.insertPredictSteps(cStep, coarse=True)
+      cStep = self._insertFunctionStep(self.selectStep, prerequisites=coarseSteps)
+    pSteps = self.insertPredictSteps(cStep)
+    mStep = self._insertFunctionStep(self.mergeStep, prerequisites=pSteps)
+    if self.isInputStreaming():
+      mStep = self._insertFunctionStep(self.registerStep, prerequisites=[mStep])
+    return [mStep]
 
-  def convertStep(self):
-    smiDir = self.getInputSMIDir()
-    if not os.path.exists(smiDir):
-      os.makedirs(smiDir)
 
-    molDir = self.copyInputMolsInDir()
-    args = f' --multiFiles -iD "{molDir}" --pattern "*" -of smi --outputDir "{smiDir}"'
-    pwchemPlugin.runScript(self, 'obabel_IO.py', args, env=OPENBABEL_DIC, cwd=smiDir)
+  def insertPredictSteps(self, prerequisite, coarse=False):
+    '''Inserts the inference of the shards of a docking stage, as parallel steps or as a single job array step'''
+    if self.useJobArray.get():
+      return [self._insertFunctionStep(self.jobArrayStep, coarse, prerequisites=[prerequisite])]
+    pSteps = []
+    for it in range(self.getNumberOfShards()):
+      pSteps.append(self._insertFunctionStep(self.predictStep, it, coarse, prerequisites=[prerequisite]))
+    return pSteps
+
+  @measuredStep
+  def convertStep(self, nInputMols=None):
+    '''Converts the receptors and the first nInputMols input molecules (the size of the input when the step was
+    inserted), so a continued execution converts again an input set that grew'''
+    if nInputMols is not None:
+      self.nInputMols.set(nInputMols)
+      self._store(self.nInputMols)
+    self.checkDockingParams()
+    if self.useLibrary.get():
+      self.convertLibrary()
+    else:
+      self.convertInputMols()
+    self._inputSMIs, self._dockedTitles, self._representatives = None, None, None
+    self._complexMolecules, self._inputMolIds = None, None
+    if self.incremental.get():
+      self.writeDockedTitles()
+    self.countDuplicates()
+    for recId, inASFile in self.getInputReceptorFiles().items():
+      self.prepareReceptor(inASFile, self.getReceptorFile(recId))
+    if self.autoBatchSize.get():
+      self.measureShardMemory()
+
+    if self.inputPockets.get() is not None:
+      for pocket in self.inputPockets.get():
+        radius = pocket.getDiameter() / 2 + self.pocketMargin.get()
+        cropStructure(self.getReceptorFile(None), pocket.calculateMassCenter(), radius,
+                      self.getReceptorFile(pocket.getObjId()))
+
+  @measuredStep
+  def cacheLookupStep(self):
+    '''Copies the poses of the complexes found in the cache to their output directories, so they are not docked'''
+    cache, hits = self.getPoseCache(), 0
+    complexDic = self.getInputComplexes()
+    for cName, (recId, _, smi) in complexDic.items():
+      cachedFiles = cache.get(self.getComplexCacheKey(recId, smi))
+      if cachedFiles:
+        oDir = self._getExtraPath(cName)
+        os.makedirs(oDir, exist_ok=True)
+        for cFile in cachedFiles:
+          linkOrCopy(cFile, os.path.join(oDir, os.path.basename(cFile)))
+        hits += 1
+
+    self.cacheHits.set(hits)
+    self.cacheMisses.set(len(complexDic) - hits)
+    self._store(self.cacheHits, self.cacheMisses)
+
+  @measuredStep
+  def embeddingStep(self):
+    recFiles = ' '.join(self.getReceptorFile(recId) for recId in self.getReceptorIds())
+    # Nothing else runs at the same time, so in CPU mode the embeddings use all the protocol threads
+    self.runJob(self.getInferenceProgram(nThreads=self.numberOfThreads.get()), f'--precompute_esm {recFiles}',
+                cwd=self.getInferenceDir())
+
+  @measuredStep
+  def predictStep(self, shardIdx, coarse=False):
+    '''Docks the pending complexes of a shard. In the first stage of the progressive docking (coarse), all the
+    complexes are docked with the first stage settings'''
+    nSamples, inferSteps = self.getStageSettings(coarse)
+    complexDic = self.getPendingComplexes(shardIdx, coarse=coarse)
+    batchSize = self.getBatchSize(complexDic, nSamples)
+    logFile = self.getInferenceLog(shardIdx, coarse)
+    while complexDic:
+      csvFile = self.buildCSVFile(shardIdx, complexDic)
+      args = self.getInferenceArgs(csvFile, self.getShardDir(shardIdx, coarse), batchSize, nSamples, inferSteps)
+      logOffset = os.path.getsize(logFile) if os.path.exists(logFile) else 0
+      error = None
+      try:
+        self.runInference(args, logFile)
+      except Exception as e:
+        error = e
 
-    inASFile = self.inputAtomStruct.get().getFileName()
-    outASFile = os.path.abspath(self._getTmpPath(getBaseName(inASFile) + '.pdb'))
-    if inASFile.endswith('.pdbqt'):
-      pdbqt2other(self, inASFile, outASFile)
+      # DiffDock skips the complexes it fails on, out of memory included, and still finishes successfully
+      complexDic = self.getPendingComplexes(shardIdx, checkShard=True, coarse=coarse)
+      if complexDic and batchSize > 1 and isOutOfMemoryLog(logFile, logOffset):
+        batchSize //= 2
+        print(f'DiffDock ran out of memory in shard {shardIdx}. '
+              f'Retrying its {len(complexDic)} pending complexes with batch size {batchSize}')
+      elif error:
+        raise error
+      else:
+        break
+    self.recordInferenceMetrics(shardIdx, coarse)
+
+  @measuredStep
+  def jobArrayStep(self, coarse=False):
+    '''Runs the inference of the shards with pending complexes as the tasks of a job array and waits for them.
+    The pending complexes of the tasks that ran out of memory are submitted again with half the batch size'''
+    nSamples, inferSteps = self.getStageSettings(coarse)
+    jobArray, batchSizes = self.getJobArray(coarse), {}
+    pendingDic = {it: self.getPendingComplexes(it, coarse=coarse) for it in range(self.getNumberOfShards())}
+    pendingDic = {it: complexDic for it, complexDic in pendingDic.items() if complexDic}
+    try:
+      while pendingDic:
+        logOffsets = {}
+        for it, complexDic in pendingDic.items():
+          batchSizes.setdefault(it, self.getBatchSize(complexDic, nSamples))
+          args = self.getInferenceArgs(self.buildCSVFile(it, complexDic), self.getShardDir(it, coarse),
+                                       batchSizes[it], nSamples, inferSteps)
+          logFile = os.path.abspath(self.getInferenceLog(it, coarse))
+          logOffsets[it] = os.path.getsize(logFile) if os.path.exists(logFile) else 0
+          jobArray.writeTask(it, f'{self.getInferenceProgram()} {getLoggedArgs(args, logFile)}',
+                             cwd=self.getInferenceDir())
+
+        print(f'Submitting {len(pendingDic)} DiffDock inference tasks in {jobArray.jobsDir}')
+        jobArray.submit(list(pendingDic))
+        exitCodes, failed, retryDic = jobArray.wait(), [], {}
+        for it in pendingDic:
+          complexDic = self.getPendingComplexes(it, checkShard=True, coarse=coarse)
+          if complexDic and batchSizes[it] > 1 and isOutOfMemoryLog(self.getInferenceLog(it, coarse), logOffsets[it]):
+            batchSizes[it] //= 2
+            print(f'DiffDock ran out of memory in shard {it}. '
+                  f'Retrying its {len(complexDic)} pending complexes with batch size {batchSizes[it]}')
+            retryDic[it] = complexDic
+          elif exitCodes[it] != 0:
+            failed.append(it)
+        if failed:
+          raise Exception(f'The inference tasks of the shards {failed} failed. '
+                          f'Check their logs in {self._getExtraPath()}')
+        pendingDic = retryDic
+    finally:
+      for it in batchSizes:
+        self.recordInferenceMetrics(it, coarse)
+
+  @measuredStep
+  def selectStep(self):
+    '''Merges the first stage shards and selects the top fraction of the complexes by their best confidence to be
+    docked again with the full settings. The rest of the complexes are moved to the output with their coarse poses'''
+    coarseDir, outDir = self.getCoarseDir(), os.path.abspath(self._getExtraPath())
+    os.makedirs(coarseDir, exist_ok=True)
+    for it in range(self.getNumberOfShards()):
+      shardDir = self.getShardDir(it, coarse=True)
+      if os.path.exists(shardDir):
+        mergeShardOutputs(shardDir, coarseDir)
+
+    coarseIndex = {cName: poses for cName, poses in indexOutputDocks(coarseDir).items() if poses}
+    ranked = sorted(coarseIndex, key=lambda cName: max(conf for _, conf, _ in coarseIndex[cName]), reverse=True)
+    nRefine = math.ceil(len(ranked) * self.refineFraction.get())
+    with open(self.getRefineFile(), 'w') as f:
+      f.write(''.join(f'{cName}\n' for cName in ranked[:nRefine]))
+    with self._outputLock:
+      for cName in ranked[nRefine:]:
+        moveComplexDir(os.path.join(coarseDir, cName), outDir)
+
+    self.nRefined.set(nRefine)
+    self._store(self.nRefined)
+    print(f'{nRefine} of {len(ranked)} complexes selected to be docked with the full settings')
+
+  def runInference(self, args, logFile):
+    '''Runs DiffDock inference, in the persistent worker if available, writing its output to logFile'''
+    if self.useWorker.get() and not self.cpuMode.get() and not diffdockPlugin.getVar(DIFFDOCK_INFERENCE_VAR) \
+        and diffdockPlugin.startInferenceWorker():
+      print(f'Running DiffDock inference in the persistent worker. Log in {logFile}')
+      returnCode = diffdockPlugin.runInferenceInWorker(shlex.split(args), logFile, self.getESMCacheDir(),
+                                                       self.getReceptorCacheDir())
+      if returnCode != 0:
+        raise Exception(f'DiffDock inference failed in the persistent worker. Check {logFile}')
     else:
-      os.link(inASFile, outASFile)
+      print(f'Running DiffDock inference. Log in {logFile}')
+      self.runJob(self.getInferenceProgram(), getLoggedArgs(args, os.path.abspath(logFile)),
+                  cwd=self.getInferenceDir())
 
-  def predictStep(self):
-    csvFile = self.buildCSVFile()
+  @measuredStep
+  def mergeStep(self):
     outDir = os.path.abspath(self._getExtraPath())
+    shardDirs = [self.getShardDir(it) for it in range(self.getNumberOfShards())]
+    with self._outputLock:
+      for shardDir in [shardDir for shardDir in shardDirs if os.path.exists(shardDir)]:
+        if self.useCache.get():
+          self.storeInCache(self.parseOutputDocks(shardDir))
+        mergeShardOutputs(shardDir, outDir)
+      if os.path.exists(self.getCoarseDir()):
+        # Complexes whose second stage failed keep their first stage poses
+        mergeShardOutputs(self.getCoarseDir(), outDir, overwrite=False)
+
+      if self.packOutput.get():
+        self.packOutputs(self.prunePoses(self.parseOutputDocks()))
+        writeManifest(self.getPackedIndexFile(), {}, append=True)
+        shutil.copyfile(self.getPackedIndexFile(), self.getManifestFile())
+      elif self.incremental.get() and os.path.exists(self.getManifestFile()):
+        # The complexes of previous executions are already pruned and in the manifest
+        previousNames = indexManifest(self.getManifestFile())
+        writeManifest(self.getManifestFile(), self.prunePoses(self.parseOutputDocks(skipNames=previousNames)),
+                      append=True)
+      else:
+        writeManifest(self.getManifestFile(), self.prunePoses(self.parseOutputDocks()))
+
+  @measuredStep
+  def registerStep(self):
+    '''Appends to the output set the poses of the molecules docked in a round of a streamed input, leaving the set
+    open for the next rounds'''
+    with self._outputLock:
+      self.registerOutputs(closeSet=False, fromManifest=True)
 
-    program = f'{pwchemPlugin.getEnvActivationCommand(DIFFDOCK_DIC)} && python -m inference '
+  def createOutputStep(self):
+    with measureResources(self.getStepMetricsFile(), 'createOutputStep'):
+      with self._outputLock:
+        self.registerOutputs(closeSet=True)
+      if os.path.exists(self.getManifestFile()):
+        PoseSummary(self.getSummaryFile()).build(self.getManifestFile())
+
+    with open(self.getMetricsFile(), 'w') as f:
+      json.dump(summarizeMetrics(readMetrics(self.getStepMetricsFile())), f, indent=2)
+
+  def _stepsCheck(self):
+    if self.isInputStreaming():
+      self.checkNewInput()
+    if self.streamOutput.get():
+      with self._outputLock:
+        self.registerOutputs(closeSet=False)
+
+  def checkNewInput(self):
+    '''When the input set is streamed, inserts a new docking round for the molecules added to it once the previous
+    round finished, and releases the output step when the input set is closed and all its molecules are docked'''
+    outputStep = next((step for step in self._steps if step.funcName.get() == 'createOutputStep'), None)
+    if outputStep is None or not outputStep.isWaiting():
+      return
+    if not all(step.isFinished() for step in self._steps if step is not outputStep):
+      return
+
+    with self.openInputMols() as inputMols:
+      nInputMols, streamClosed = len(inputMols), inputMols.isStreamClosed()
+    if nInputMols > self.nInputMols.get():
+      outputStep.addPrerequisites(*self.insertDockingSteps())
+    elif streamClosed:
+      outputStep.setStatus(STATUS_NEW)
+    self.updateSteps()
+
+  def _validate(self):
+    errors = []
+    if self.useLibrary.get() and not os.path.exists(self.inputLibrary.get() or ''):
+      errors.append('The input SMILES library file does not exist')
+    if self.inputPockets.get() is not None and isinstance(self.inputAtomStruct.get(), SetOfAtomStructs):
+      errors.append('Pockets can only be used to restrict the docking on a single input structure')
+    if self.clusterPoses.get() and self.clusterRMSD.get() <= 0:
+      errors.append('The clustering RMSD must be positive')
+    if self.useJobArray.get() and self.nArrayTasks.get() < 1:
+      errors.append('The job array needs at least one task')
+    if self.cpuMode.get() and self.cpuProcesses.get() < 0:
+      errors.append('The number of concurrent inference processes cannot be negative')
+    if self.incremental.get() and not self.useLibrary.get() and self.progressive.get():
+      errors.append('The progressive docking cannot be used to dock only the new molecules')
+    if self.progressive.get() and not 0 < self.refineFraction.get() <= 1:
+      errors.append('The fraction of ligands to refine must be in the interval (0, 1]')
+    return errors
+
+  def _summary(self):
+    summary = []
+    if self.useCache.get() and self.cacheHits.get() is not None:
+      summary.append(f'Pose cache: {self.cacheHits.get()} hits, {self.cacheMisses.get()} misses')
+    if self.progressive.get() and self.nRefined.get() is not None:
+      summary.append(f'Progressive docking: {self.nRefined.get()} complexes docked again with the full settings')
+    if self.nDuplicates.get():
+      summary.append(f'{self.nDuplicates.get()} duplicated molecules were not docked again')
+    if self.nFailed.get():
+      summary.append(f'No poses were generated for {self.nFailed.get()} complexes (listed in {self.getFailedFile()})')
+    if os.path.exists(self.getMetricsFile()):
+      summary += self.getMetricsSummary()
+    return summary
+
+  ###########################################################
+
+  def parseOutputDocks(self, oDir=None, skipNames=()):
+    '''Returns the poses index {complexName: [(rank, confidence, path), ...]} of the complex directories in oDir'''
+    oDir = oDir if oDir else self._getExtraPath()
+    return indexOutputDocks(oDir, set(skipNames) | self.getWorkingDirNames())
+
+  def getWorkingDirNames(self):
+    '''Returns the names of the directories in extra that are not complex outputs'''
+    dirNames = {os.path.basename(self.getShardDir(it)) for it in range(self.getNumberOfShards())}
+    return dirNames | {os.path.basename(self.getCoarseDir()), 'jobs', 'jobs_coarse'}
+
+  def getComplexDirNames(self):
+    '''Returns the names of the complex output directories in extra, without indexing their poses'''
+    workingDirNames = self.getWorkingDirNames()
+    with os.scandir(self._getExtraPath()) as entries:
+      return {entry.name for entry in entries if entry.is_dir() and entry.name not in workingDirNames}
+
+  def getManifestFile(self):
+    return self._getExtraPath('outputManifest.tsv')
+
+  def getPackedFile(self):
+    return self._getExtraPath('outputPoses.sdf')
+
+  def getPackedIndexFile(self):
+    return self._getExtraPath('outputPoses.tsv')
+
+  def getSummaryFile(self):
+    return self._getExtraPath('poseSummary.sqlite')
+
+  def getFailedFile(self):
+    return self._getExtraPath('failedLigands.txt')
+
+  def getStepMetricsFile(self):
+    return self._getExtraPath('stepMetrics.jsonl')
+
+  def getMetricsFile(self):
+    return self._getExtraPath('metrics.json')
+
+  def getInferenceLog(self, shardIdx, coarse=False):
+    return self._getExtraPath(f'inference_coarse_{shardIdx}.log' if coarse else f'inference_{shardIdx}.log')
+
+  def recordInferenceMetrics(self, shardIdx, coarse=False):
+    '''Records the sampling time of each complex and the peak memory of the inference found in the shard log'''
+    complexTimes, peakRSS = parseInferenceLog(self.getInferenceLog(shardIdx, coarse))
+    if coarse:
+      complexTimes = {f'coarse/{cName}': seconds for cName, seconds in complexTimes.items()}
+    if complexTimes or peakRSS:
+      appendMetrics(self.getStepMetricsFile(), {'step': 'inference', 'args': [shardIdx, coarse],
+                                                'wallTime': round(sum(complexTimes.values()), 3),
+                                                'childrenPeakRSS': peakRSS, 'complexTimes': complexTimes})
+
+  def getMetricsSummary(self):
+    with open(self.getMetricsFile()) as f:
+      metrics = json.load(f)
+    summary = []
+    for stepName, stepMetrics in metrics['steps'].items():
+      summary.append(f'{stepName}: {stepMetrics["wallTime"]:.1f} s wall, {stepMetrics["cpuTime"]:.1f} s CPU, '
+                     f'{stepMetrics["peakRSS"]:.0f} MB peak memory')
+    if 'complexes' in metrics:
+      cMetrics = metrics['complexes']
+      summary.append(f'Sampling time per complex: {cMetrics["mean"]:.1f} s mean, {cMetrics["max"]:.1f} s max '
+                     f'({cMetrics["count"]} complexes)')
+      if 'throughput' in cMetrics:
+        summary.append(f'Docking throughput: {cMetrics["throughput"] * 3600:.0f} complexes / hour')
+    return summary
+
+  def getOutputSet(self):
+    outputSet = getattr(self, 'outputSmallMolecules', None)
+    if outputSet is not None:
+      outputSet.enableAppend()
+    else:
+      outDir = self._getPath('outputLigands')
+      if not os.path.exists(outDir):
+        os.mkdir(outDir)
+      outputSet = SetOfSmallMolecules().create(outputPath=outDir)
+      outputSet.proteinFile.set(list(self.getInputReceptorFiles().values())[0])
+      outputSet.setDocked(True)
+    return outputSet
+
+  def collectCompletedComplexes(self):
+    '''Moves the complete complex directories of the running shards to the extra directory'''
+    outDir = os.path.abspath(self._getExtraPath())
+    for it in range(self.getNumberOfShards()):
+      shardDir = self.getShardDir(it)
+      if os.path.exists(shardDir):
+        completeIndex = {cName: poses for cName, poses in self.parseOutputDocks(shardDir).items()
+                         if len(poses) >= self.nSamples.get()}
+        if self.useCache.get() and completeIndex:
+          self.storeInCache(completeIndex)
+        for cName in completeIndex:
+          moveComplexDir(os.path.join(shardDir, cName), outDir)
+
+  def getRegisteredFile(self):
+    return self._getExtraPath('registeredComplexes.txt')
+
+  def getRegisteredComplexes(self):
+    registered = set()
+    if os.path.exists(self.getRegisteredFile()):
+      with open(self.getRegisteredFile()) as f:
+        registered = set(f.read().split())
+    return registered
+
+  def registerOutputs(self, closeSet, fromManifest=None):
+    '''Appends to the output set the poses of the input molecules that are not registered yet.
+    While streaming, only complete complexes are registered and the set is left open.
+    When closing (or fromManifest), the poses of each complex are read lazily from the manifest and a single template
+    molecule is reused for all the poses of each input molecule, committing the set periodically, so the memory does
+    not grow with the number of poses'''
+    fromManifest = closeSet if fromManifest is None else fromManifest
+    if not closeSet and not os.path.exists(self._getExtraPath()):
+      return
+    registered, manifestF = self.getRegisteredComplexes(), None
+    if fromManifest and os.path.exists(self.getManifestFile()):
+      offsets = indexManifest(self.getManifestFile())
+      manifestF = open(self.getManifestFile(), 'rb')
+      newNames = set(offsets)
+      dockedNames = self.getDockedNames()
+
+      def getPoses(cName):
+        return readManifestPoses(manifestF, offsets[cName], cName)
+    else:
+      if not closeSet:
+        self.collectCompletedComplexes()
+      poseIndex = self.parseOutputDocks(skipNames=registered)
+      # The empty directories of the complexes DiffDock failed on are not registered, so they can be docked again
+      newIndex = self.prunePoses({cName: poses for cName, poses in poseIndex.items() if poses})
+      if self.packOutput.get() and not closeSet:
+        newIndex = self.packOutputs(newIndex)
+      if not newIndex and not closeSet:
+        return
+      newNames, getPoses = set(newIndex), newIndex.get
+      dockedNames = self.getDockedNames() if closeSet else set()
+
+    outputSet, failed, newRegistered, nPoses = self.getOutputSet(), [], [], 0
+    recIds, recFiles, representatives = self.getReceptorIds(), self.getInputReceptorFiles(), self.getRepresentatives()
+    usePockets, ensemble = self.inputPockets.get() is not None, self.isEnsembleDocking()
+    # While streaming, only the molecules of the new complexes not registered yet are read, not the whole input
+    molTitles = None
+    if not closeSet:
+      complexMolecules = self.getComplexMolecules()
+      molTitles = list(dict.fromkeys(title for cName in newNames for title, molCName in complexMolecules.get(cName, [])
+                                     if molCName not in registered))
+    try:
+      for molName, smallMol in self.iterInputMolecules(molTitles):
+        template = None
+        for recId in recIds:
+          cName, molCName = getComplexName(representatives.get(molName, molName), recId), getComplexName(molName, recId)
+          if closeSet and cName not in dockedNames:
+            failed.append(molCName)
+          if cName not in newNames or molCName in registered:
+            continue
+          newRegistered.append(molCName)
+          poses = getPoses(cName)
+          if not poses:
+            continue
+          template = template if template else self.buildPoseTemplate(smallMol, molName)
+          if ensemble:
+            template._receptorId.set(recId)
+            template._receptorFile.set(recFiles[recId])
+          template.gridId.set(recId if usePockets else 1)
+          nPoses = appendPoses(outputSet, template, poses, nPoses)
+    finally:
+      if manifestF:
+        manifestF.close()
+
+    with open(self.getRegisteredFile(), 'a') as f:
+      f.write(''.join(f'{cName}\n' for cName in newRegistered))
+    if closeSet:
+      self.reportFailedLigands(failed)
+    state = outputSet.STREAM_CLOSED if closeSet else outputSet.STREAM_OPEN
+    self._updateOutputSet('outputSmallMolecules', outputSet, state)
+
+  def iterInputMolecules(self, titles=None):
+    '''Yields the (name, smallMolecule) of the input molecules, or only of those with the given titles. The molecules
+    of a library input are not created and None is yielded instead'''
+    if self.useLibrary.get():
+      for title in self.getInputSMIs() if titles is None else titles:
+        yield title, None
+    elif titles is None:
+      with self.openInputMols() as inputMols:
+        for smallMol in itertools.islice(inputMols, self.nInputMols.get()):
+          yield getBaseName(smallMol.getFileName()), smallMol
+    else:
+      molIds = self.getInputMolIds()
+      with self.openInputMols() as inputMols:
+        for title in titles:
+          yield title, inputMols[molIds[title]]
+
+  def getInputMolIds(self):
+    '''Returns the {title: objectId} of the input molecules, so they can be read from the set one by one'''
+    if getattr(self, '_inputMolIds', None) is None:
+      with self.openInputMols() as inputMols:
+        self._inputMolIds = {getBaseName(mol.getFileName()): mol.getObjId()
+                             for mol in itertools.islice(inputMols, self.nInputMols.get())}
+    return self._inputMolIds
+
+  def getComplexMolecules(self):
+    '''Returns {complexName: [(title, moleculeComplexName)]} with the input molecules whose poses are those of each
+    docked complex: the molecule docked and the duplicates it represents'''
+    if getattr(self, '_complexMolecules', None) is None:
+      self._complexMolecules, recIds = {}, self.getReceptorIds()
+      for title, repTitle in self.getRepresentatives().items():
+        for recId in recIds:
+          self._complexMolecules.setdefault(getComplexName(repTitle, recId), []).append(
+            (title, getComplexName(title, recId)))
+    return self._complexMolecules
+
+  @contextlib.contextmanager
+  def openInputMols(self):
+    '''Yields the input set of molecules. In incremental mode, it is loaded again from its file, so the molecules
+    added to a streamed set are found, and closed afterwards'''
+    if not self.incremental.get():
+      yield self.inputSmallMols.get()
+      return
+    inputMols = SetOfSmallMolecules(filename=self.inputSmallMols.get().getFileName())
+    try:
+      inputMols.loadAllProperties()
+      yield inputMols
+    finally:
+      inputMols.close()
+
+  def isInputStreaming(self):
+    '''Returns whether the molecules of an input set that is still being filled are docked in rounds'''
+    if not self.incremental.get() or self.useLibrary.get():
+      return False
+    with self.openInputMols() as inputMols:
+      return inputMols.isStreamOpen()
+
+  def buildLibraryMolecule(self, title):
+    '''Creates the small molecule of a library entry, writing its SMILES file. The files are kept out of the extra
+    directory, whose subdirectories are the complex outputs'''
+    molDir = self._getPath('libraryMolecules')
+    os.makedirs(molDir, exist_ok=True)
+    molFile = os.path.join(molDir, f'{title}.smi')
+    with open(molFile, 'w') as f:
+      f.write(f'{self.getInputSMIs()[title]} {title}\n')
+    return SmallMolecule(smallMolFilename=molFile)
+
+  def buildPoseTemplate(self, smallMol, molName=None):
+    '''Returns a copy of an input molecule (or of the library molecule molName if None) with the attributes of the
+    DiffDock poses, to be filled for each of them'''
+    template = SmallMolecule()
+    template.copy(smallMol if smallMol is not None else self.buildLibraryMolecule(molName), copyId=False)
+    template._energy = pwobj.Float()
+    if self.packOutput.get():
+      template._poseOffset = pwobj.Integer()
+    if self.isEnsembleDocking():
+      template._receptorId, template._receptorFile = pwobj.Integer(), pwobj.String()
+    template.setMolClass('DiffDock')
+    template.setDockId(self.getObjId())
+    return template
+
+  def getComplexReceptorFile(self, cName):
+    '''Returns the input receptor file a complex was docked on'''
+    recFiles = self.getInputReceptorFiles()
+    if self.isEnsembleDocking():
+      return recFiles[int(cName.rpartition('_rec')[2])]
+    return list(recFiles.values())[0]
+
+  def isEnsembleDocking(self):
+    '''Returns whether the ligands are docked on each structure of a set, so the poses store their receptor'''
+    return isinstance(self.inputAtomStruct.get(), SetOfAtomStructs) and self.inputPockets.get() is None
+
+  def reportFailedLigands(self, failed):
+    '''Stores the names of the input complexes DiffDock did not produce any pose for'''
+    with open(self.getFailedFile(), 'w') as f:
+      f.write(''.join(f'{cName}\n' for cName in failed))
+    self.nFailed.set(len(failed))
+    self._store(self.nFailed)
+    if failed:
+      print(f'WARNING: no poses were generated for {len(failed)} complexes. Their names are in {self.getFailedFile()}')
+
+  def getPendingComplexes(self, shardIdx, checkShard=None, coarse=False):
+    '''Returns the shard complexes that still need to be docked. The complexes in the extra directory
+    or packed (served from the cache, streamed or merged in a previous execution) are always complete and, if resuming,
+    the complexes in the shard directory with the expected number of poses are also skipped'''
+    checkShard = self.resumeDocking.get() if checkShard is None else checkShard
+    complexDic = self.getShardComplexes(shardIdx, coarse)
+    completed = self.getDockedNames()
+    shardDir = self.getShardDir(shardIdx, coarse)
+    if checkShard and os.path.exists(shardDir):
+      completed |= {cName for cName, poses in self.parseOutputDocks(shardDir).items()
+                    if len(poses) >= self.getStageSettings(coarse)[0]}
+
+    completed &= set(complexDic)
+    if completed:
+      print(f'Skipping {len(completed)} complexes already docked in shard {shardIdx}')
+    return {cName: cInfo for cName, cInfo in complexDic.items() if cName not in completed}
+
+  def getDockedNames(self):
+    '''Returns the names of the complexes DiffDock generated poses for: the merged ones and those with poses in their
+    own directory. DiffDock leaves an empty directory for the complexes it fails on'''
+    dockedNames = self.getMergedNames()
+    for cName in self.getComplexDirNames() - dockedNames:
+      if indexComplexDir(self._getExtraPath(cName)):
+        dockedNames.add(cName)
+    return dockedNames
+
+  def getMergedNames(self):
+    '''Returns the names of the complexes whose poses are in the manifest or packed, or were all pruned'''
+    mergedNames = self.getPrunedComplexes()
+    for indexFile in [self.getManifestFile(), self.getPackedIndexFile()]:
+      if os.path.exists(indexFile):
+        mergedNames |= set(indexManifest(indexFile))
+    return mergedNames
+
+  def getPrunedFile(self):
+    return self._getExtraPath('prunedComplexes.txt')
+
+  def getPrunedComplexes(self):
+    '''Returns the names of the complexes whose poses were all removed by the pose filters'''
+    pruned = set()
+    if os.path.exists(self.getPrunedFile()):
+      with open(self.getPrunedFile()) as f:
+        pruned = set(f.read().split())
+    return pruned
+
+  def packOutputs(self, poseIndex):
+    '''Packs the poses of the index in the multi-record sdf file, removing their complex directories.
+    Returns the index with the packed pose references'''
+    packedIndex = packPoses(poseIndex, self.getPackedFile())
+    writeManifest(self.getPackedIndexFile(), packedIndex, append=True)
+    for cName in poseIndex:
+      shutil.rmtree(self._getExtraPath(cName))
+    return packedIndex
+
+  def prunePoses(self, poseIndex):
+    '''Keeps only the top ranked poses of each complex over the minimum confidence, optionally after collapsing the
+    redundant poses, and optionally deleting the files of the rest'''
+    prunedIndex, clustered = {}, {}
+    if self.clusterPoses.get() and poseIndex:
+      clustered = clusterPoseIndex(poseIndex, self.clusterRMSD.get(), self.numberOfThreads.get())
+      nRedundant = sum(len(redundant) for _, redundant in clustered.values())
+      print(f'{nRedundant} redundant poses collapsed in {len(clustered)} complexes')
+
+    for cName, poses in poseIndex.items():
+      poses, redundant = clustered.get(cName, (poses, []))
+      prunedIndex[cName], dropped = filterPoses(poses, self.keepTopK.get(), self.minConfidence.get())
+      dropped += redundant
+      if self.deletePruned.get():
+        for _, _, path in dropped:
+          os.remove(path)
+
+    pruned = [cName for cName, poses in poseIndex.items() if poses and not prunedIndex[cName]]
+    with open(self.getPrunedFile(), 'a') as f:
+      f.write(''.join(f'{cName}\n' for cName in pruned))
+    return prunedIndex
+
+  def getInferenceProgram(self, nThreads=None):
+    '''Returns the command running the DiffDock inference wrapper, which also reports the time of each complex.
+    In CPU mode, the process uses nThreads (by default, its share of the protocol threads) and no GPU.
+    If the DIFFDOCK_INFERENCE_PROGRAM variable is set, its command is run instead (e.g: to test with the stub)'''
+    if diffdockPlugin.getVar(DIFFDOCK_INFERENCE_VAR):
+      return f'{diffdockPlugin.getVar(DIFFDOCK_INFERENCE_VAR)} '
+    program = f'{pwchemPlugin.getEnvActivationCommand(self.getInferenceEnv())} && '
+    if self.cpuMode.get():
+      nThreads = nThreads if nThreads else self.getInferenceThreads()
+      program += ' '.join(f'{var}={shlex.quote(value)}'
+                          for var, value in getThreadsEnviron(nThreads, cpuOnly=True).items())
+      program += f' python {diffdockPlugin.getScriptsDir("diffdock_inference.py")} --threads {nThreads} '
+    else:
+      program += f'python {diffdockPlugin.getScriptsDir("diffdock_inference.py")} '
+    if self.cacheESM.get():
+      program += f'--esm_cache_dir {self.getESMCacheDir()} '
+    if self.cacheReceptor.get():
+      program += f'--receptor_cache_dir {self.getReceptorCacheDir()} '
+    return program
+
+  def getInferenceDir(self):
+    '''Returns the working directory of the inference: the DiffDock repository, or the protocol directory if the
+    inference is replaced by the DIFFDOCK_INFERENCE_PROGRAM command'''
+    if diffdockPlugin.getVar(DIFFDOCK_INFERENCE_VAR):
+      return os.path.abspath(self._getPath())
+    return diffdockPlugin.getPackageDir('DiffDock')
+
+  def getStageSettings(self, coarse=False):
+    '''Returns the number of positions and inference steps of the docking stage'''
+    if coarse:
+      return self.coarseSamples.get(), self.coarseSteps.get()
+    return self.nSamples.get(), self.inferSteps.get()
+
+  def getCoarseDir(self):
+    return os.path.abspath(self._getExtraPath('coarse'))
+
+  def getRefineFile(self):
+    return self._getExtraPath('refineComplexes.txt')
+
+  def getRefineComplexes(self):
+    '''Returns the names of the complexes selected to be docked in the second stage of the progressive docking'''
+    with open(self.getRefineFile()) as f:
+      return f.read().split()
+
+  def getBatchSize(self, complexDic, nSamples=None):
+    '''Returns the inference batch size. In automatic mode, it is estimated from the memory available for each
+    shard, measured in the conversion step, and the size of the biggest ligand'''
+    nSamples = nSamples if nSamples else self.nSamples.get()
+    if not self.autoBatchSize.get():
+      return self.batchSize.get()
+    if not complexDic:
+      return 1
+    maxHeavyAtoms = max(countHeavyAtoms(smi) for _, _, smi in complexDic.values())
+    batchSize = estimateBatchSize(self.shardMemory.get(), maxHeavyAtoms, nSamples)
+    print(f'Using batch size {batchSize} for {self.shardMemory.get():.0f} MB of memory '
+          f'and ligands up to {maxHeavyAtoms} heavy atoms')
+    return batchSize
+
+  def measureShardMemory(self):
+    '''Stores the memory available for each shard, measured before any inference runs, as the memory used by the
+    running shards would be counted again if each shard measured it when it starts'''
+    availableMem, onGPU = getAvailableMemory(useGPU=not self.cpuMode.get())
+    self.shardMemory.set(availableMem / self.getNumberOfShards())
+    self._store(self.shardMemory)
+    print(f'{self.shardMemory.get():.0f} MB of {"GPU" if onGPU else "RAM"} memory available for each of the '
+          f'{self.getNumberOfShards()} inference shards')
+
+  def getInferenceArgs(self, csvFile, outDir, batchSize, nSamples=None, inferSteps=None):
+    nSamples = nSamples if nSamples else self.nSamples.get()
+    inferSteps = inferSteps if inferSteps else self.inferSteps.get()
     args = f'--protein_ligand_csv {csvFile} --out_dir {outDir} '
-    args += f'--inference_steps {self.inferSteps.get()} --samples_per_complex {self.nSamples.get()} ' \
-            f'--batch_size {self.batchSize.get()} '
+    args += f'--inference_steps {inferSteps} --samples_per_complex {nSamples} --batch_size {batchSize} '
     if not self.finalDenoise.get():
       args += '--no_final_step_noise '
 
@@ -115,94 +972,303 @@ class ProtDiffDockDocking(EMProtocol):
       args += f'--model_dir {scoreModelDir} '
     if confModelDir:
       args += f'--confidence_model_dir {confModelDir} '
+    return args
 
-    self.runJob(program, args, cwd=diffdockPlugin.getPackageDir('DiffDock'))
+  def getESMCacheDir(self):
+    return diffdockPlugin.getCacheDir('esm') if self.cacheESM.get() else None
 
-  def createOutputStep(self):
-    outDir = self._getPath('outputLigands')
-    if not os.path.exists(outDir):
-      os.mkdir(outDir)
-    outputSet = SetOfSmallMolecules().create(outputPath=outDir)
+  def getReceptorCacheDir(self):
+    return diffdockPlugin.getCacheDir('receptors') if self.cacheReceptor.get() else None
 
-    outDic = self.parseOutputDocks()
-    for smallMol in self.inputSmallMols.get():
-      molName = getBaseName(smallMol.getFileName())
-      for outFile in outDic[molName]:
-        conf = outFile.split('_confidence')[-1].split('.sdf')[0]
-        posId = outFile.split('/rank')[-1].split('_')[0]
+  def getPoseCache(self):
+    cacheDir = self.cacheDir.get() if self.cacheDir.get() else diffdockPlugin.getCacheDir()
+    maxSize = int(self.cacheMaxSize.get() * 1024 ** 3) if self.cacheMaxSize.get() else None
+    return PoseCache(cacheDir, maxSize)
 
-        newSmallMol = SmallMolecule()
-        newSmallMol.copy(smallMol, copyId=False)
-        newSmallMol._energy = pwobj.Float(conf)
-        newSmallMol.poseFile.set(outFile)
-        newSmallMol.setPoseId(posId)
-        newSmallMol.gridId.set(1)
-        newSmallMol.setMolClass('DiffDock')
-        newSmallMol.setDockId(self.getObjId())
+  def getDockingParams(self):
+    '''Returns the models and parameters that determine the poses of the docking'''
+    if getattr(self, '_dockingParams', None) is None:
+      modelHashes = [getFileHash(modelFile) if modelFile else 'default'
+                     for modelFile in [self.scoreModel.get(), self.confidenceModel.get()]]
+      self._dockingParams = {'models': modelHashes,
+                             'nSamples': self.nSamples.get(), 'inferSteps': self.inferSteps.get(),
+                             'finalDenoise': self.finalDenoise.get(), 'version': DIFFDOCK_DIC['version']}
+    return self._dockingParams
 
-        outputSet.append(newSmallMol)
+  def getComplexCacheKey(self, recId, smi):
+    '''Returns the pose cache key of a complex: the hash of the receptor file, the ligand SMILES and the model
+    and parameters that determine the poses of the docking'''
+    if getattr(self, '_receptorHashes', None) is None:
+      self._receptorHashes = {}
+    if recId not in self._receptorHashes:
+      self._receptorHashes[recId] = getFileHash(self.getReceptorFile(recId))
+    return getCacheKey(receptor=self._receptorHashes[recId], smiles=smi, **self.getDockingParams())
 
+  def getDockingParamsFile(self):
+    return self._getExtraPath('dockingParams.json')
 
-    outputSet.proteinFile.set(self.inputAtomStruct.get().getFileName())
-    outputSet.setDocked(True)
-    self._defineOutputs(outputSmallMolecules=outputSet)
+  def checkDockingParams(self):
+    '''Stores the receptors, models and parameters of the docking. In incremental mode, checks they did not change
+    since the previous execution, as the new poses are appended to the output of the previous ones'''
+    recFiles = self.getInputReceptorFiles()
+    dockingParams = dict(self.getDockingParams(), receptorIds=[str(recId) for recId in self.getReceptorIds()],
+                         receptors=[getFileHash(recFiles[recId]) for recId in sorted(recFiles, key=str)],
+                         keepTopK=self.keepTopK.get(), minConfidence=self.minConfidence.get(),
+                         clusterRMSD=self.clusterRMSD.get() if self.clusterPoses.get() else None)
+    paramsFile = self.getDockingParamsFile()
+    if self.incremental.get() and os.path.exists(paramsFile):
+      with open(paramsFile) as f:
+        if json.load(f) != json.loads(json.dumps(dockingParams)):
+          raise Exception('The receptors, models or docking parameters changed since the molecules in the output were '
+                          'docked, so the new poses cannot be appended to it. Restart the protocol to dock all the '
+                          'molecules again')
+    with open(paramsFile, 'w') as f:
+      json.dump(dockingParams, f, indent=2)
 
+  def storeInCache(self, poseIndex):
+    '''Stores in the pose cache the complete complexes of a poses index'''
+    cache = self.getPoseCache()
+    complexDic = self.getInputComplexes()
+    for cName, poses in poseIndex.items():
+      if cName in complexDic and len(poses) >= self.nSamples.get():
+        recId, _, smi = complexDic[cName]
+        cache.put(self.getComplexCacheKey(recId, smi), [path for _, _, path in poses])
+    cache.evict()
 
-  ###########################################################
+  def convertInputMols(self):
+    '''Converts the input molecules to canonical SMILES in parallel subsets, reusing the SMILES of the molecule files
+    converted in previous runs, and writes them in a single table'''
+    with self.openInputMols() as inputMols:
+      molFiles = {getBaseName(mol.getFileName()): os.path.abspath(mol.getFileName())
+                  for mol in itertools.islice(inputMols, self.nInputMols.get())}
+    fileHashes = {title: getFileHash(molFile) for title, molFile in molFiles.items()}
+    smilesCache = SmilesCache(diffdockPlugin.getCacheDir('smiles.sqlite')) if self.cacheSMILES.get() else None
+    cachedSmiles = smilesCache.getMany(set(fileHashes.values())) if smilesCache else {}
 
-  def parseOutputDocks(self):
-    outDirs = []
-    for oDir in os.listdir(self._getExtraPath()):
-      if os.path.isdir(self._getExtraPath(oDir)) and oDir != 'inputSMI':
-        outDirs.append(oDir)
+    newSmiles = {}
+    missing = [title for title in molFiles if fileHashes[title] not in cachedSmiles]
+    if missing:
+      subsets = [subset for subset in splitInShards(missing, self.numberOfThreads.get()) if subset]
+      with ThreadPoolExecutor(len(subsets)) as executor:
+        for subsetSmiles in executor.map(self.convertMolSubset, range(len(subsets)),
+                                         [{title: molFiles[title] for title in subset} for subset in subsets]):
+          newSmiles.update(subsetSmiles)
+      if smilesCache:
+        smilesCache.putMany({fileHashes[title]: smi for title, smi in newSmiles.items()})
+    print(f'SMILES of {len(molFiles) - len(missing)} molecules reused, {len(missing)} converted')
 
-    outDic = {}
-    for oDir in outDirs:
-      outDic[oDir] = []
-      for outFile in os.listdir(self._getExtraPath(oDir)):
-        if '_confidence' in outFile:
-          outDic[oDir].append(os.path.join(self._getExtraPath(oDir), outFile))
+    with open(self.getInputSMIsFile(), 'w') as f:
+      for title in molFiles:
+        smi = cachedSmiles.get(fileHashes[title], newSmiles.get(title))
+        if smi:
+          f.write(f'{title}\t{smi}\n')
 
-    return outDic
+  def convertLibrary(self):
+    '''Writes the SMILES table of the input library, reading it in chunks of lines'''
+    entries, nMols = iterSmilesLibrary(self.inputLibrary.get()), 0
+    with open(self.getInputSMIsFile(), 'w') as f:
+      for chunk in iter(lambda: list(itertools.islice(entries, LIBRARY_CHUNK_SIZE)), []):
+        f.writelines(f'{title}\t{smi}\n' for title, smi in chunk)
+        nMols += len(chunk)
+    print(f'{nMols} molecules read from the library {self.inputLibrary.get()}')
 
-  def copyInputMolsInDir(self):
-    oDir = os.path.abspath(self._getTmpPath('inMols'))
-    if not os.path.exists(oDir):
-      os.makedirs(oDir)
+  def countDuplicates(self):
+    if self.deduplicate.get():
+      representatives = self.getRepresentatives()
+      self.nDuplicates.set(len(representatives) - len(set(representatives.values())))
+      self._store(self.nDuplicates)
 
-    for mol in self.inputSmallMols.get():
-      os.link(mol.getFileName(), os.path.join(oDir, os.path.split(mol.getFileName())[-1]))
-    return oDir
+  def convertMolSubset(self, subsetIdx, molFiles):
+    '''Converts a subset of molecule files {title: file} to canonical SMILES. Returns {title: smiles}'''
+    molDir = os.path.abspath(self._getTmpPath(f'inMols_{subsetIdx}'))
+    smiDir = os.path.abspath(self._getTmpPath(f'inputSMI_{subsetIdx}'))
+    for oDir in [molDir, smiDir]:
+      os.makedirs(oDir, exist_ok=True)
+    for molFile in molFiles.values():
+      linkOrCopy(molFile, os.path.join(molDir, os.path.basename(molFile)))
 
-  def getInputSMIDir(self):
-    return os.path.abspath(self._getExtraPath('inputSMI'))
+    args = f' --multiFiles -iD "{molDir}" --pattern "*" -of can --outputDir "{smiDir}"'
+    pwchemPlugin.runScript(self, 'obabel_IO.py', args, env=OPENBABEL_DIC, cwd=smiDir)
+
+    smiDic = {}
+    for file in os.listdir(smiDir):
+      with open(os.path.join(smiDir, file)) as f:
+        fields = f.readline().split()
+      if fields:
+        title = getBaseName(file) if getBaseName(file) in molFiles or len(fields) < 2 else fields[1]
+        smiDic[title] = fields[0]
+    return smiDic
+
+  def getInputSMIsFile(self):
+    return self._getExtraPath('inputSMILES.tsv')
 
   def getInputSMIs(self):
-    smisDic = {}
-    iDir = self.getInputSMIDir()
-    for file in os.listdir(iDir):
-      with open(os.path.join(iDir, file)) as f:
-        title, smi = f.readline().split()
-        smisDic[title] = smi.strip()
-    return smisDic
-  
-  def getInputASFile(self):
-    iASFile = None
-    for file in os.listdir(self._getTmpPath()):
-      if file.endswith('.pdb'):
-        iASFile = os.path.abspath(self._getTmpPath(file))
-    return iASFile
-
-  def getInputCSV(self):
-    return os.path.abspath(self._getExtraPath('inputPairs.csv'))
-
-  def buildCSVFile(self):
-    csvFile = self.getInputCSV()
+    '''Returns the {title: smiles} of the input molecules'''
+    if getattr(self, '_inputSMIs', None) is None:
+      with open(self.getInputSMIsFile()) as f:
+        self._inputSMIs = dict(line.rstrip('\n').split('\t') for line in f if line.strip())
+    return self._inputSMIs
+
+
+  def getInputReceptorFiles(self):
+    '''Returns the input receptor files as {receptorId: file}. The ids are the object ids of the structures if a set
+    is input, or None for a single structure'''
+    inAS = self.inputAtomStruct.get()
+    if isinstance(inAS, SetOfAtomStructs):
+      return {struct.getObjId(): struct.getFileName() for struct in inAS}
+    return {None: inAS.getFileName()}
+
+  def getReceptorIds(self):
+    '''Returns the ids of the receptors the ligands are docked on: the input structures ids or, if pockets are
+    input, the ids of the pockets, whose cropped receptors are used'''
+    if self.inputPockets.get() is not None:
+      return [pocket.getObjId() for pocket in self.inputPockets.get()]
+    return list(self.getInputReceptorFiles())
+
+  def prepareReceptor(self, inFile, outFile):
+    '''Converts an input receptor file to the cleaned pdb docked by DiffDock. If the receptor cache is used, the
+    prepared file is stored by the hash of the input file and only linked in later runs'''
+    cacheDir = self.getReceptorCacheDir()
+    cachedFile = os.path.join(cacheDir, f'{getFileHash(inFile)}.pdb') if cacheDir else None
+    if cachedFile and os.path.exists(cachedFile):
+      linkOrCopy(cachedFile, outFile)
+      return
+
+    tmpFile = f'{outFile}.tmp'
+    if inFile.endswith('.pdbqt'):
+      pdbqt2other(self, inFile, tmpFile + '.pdb')
+      cleanReceptorPDB(tmpFile + '.pdb', tmpFile)
+      os.remove(tmpFile + '.pdb')
+    elif inFile.endswith('.pdb') or inFile.endswith('.ent'):
+      cleanReceptorPDB(inFile, tmpFile)
+    else:
+      shutil.copy(inFile, tmpFile)
+
+    if cachedFile:
+      os.makedirs(cacheDir, exist_ok=True)
+      shutil.move(tmpFile, f'{cachedFile}.{os.getpid()}')
+      os.replace(f'{cachedFile}.{os.getpid()}', cachedFile)
+      linkOrCopy(cachedFile, outFile)
+    else:
+      os.replace(tmpFile, outFile)
+
+  def getReceptorFile(self, recId):
+    '''Returns the converted pdb file of a receptor'''
+    fileName = 'receptor.pdb' if recId is None else f'receptor_{recId}.pdb'
+    return os.path.abspath(self._getTmpPath(fileName))
+
+  def getInputComplexes(self, titles=None):
+    '''Returns the receptor x ligand complexes to dock as {complexName: (receptorId, ligandTitle, smiles)}'''
     smiDic = self.getInputSMIs()
-    iASFile = self.getInputASFile()
+    titles = self.getDockingTitles() if titles is None else titles
+    recIds = self.getReceptorIds()
+    return {getComplexName(title, recId): (recId, title, smiDic[title]) for title in titles for recId in recIds}
+
+  def getNumberOfShards(self):
+    '''Returns the number of ligand shards the inference is split into: one per thread (or job array task), but never
+    more than input molecules'''
+    nShards = self.nArrayTasks.get() if self.useJobArray.get() else self.getNumberOfProcesses()
+    return max(1, min(nShards, self.getNumberOfInputMols(upTo=nShards)))
+
+  def getNumberOfProcesses(self):
+    '''Returns the number of inference processes run at the same time in the protocol host: one per thread or, in
+    CPU mode, the chosen number of processes'''
+    nThreads = self.numberOfThreads.get()
+    if self.cpuMode.get() and self.cpuProcesses.get() > 0:
+      return min(self.cpuProcesses.get(), nThreads)
+    return nThreads
+
+  def getInferenceThreads(self):
+    '''Returns the CPU threads of each inference process: the protocol threads if each one runs in its own queue job,
+    or the protocol threads split among the processes running at the same time in the host otherwise'''
+    if self.useJobArray.get() and self.useQueue():
+      return self.numberOfThreads.get()
+    nProcesses = min(self.getNumberOfProcesses(), self.getNumberOfShards())
+    return splitThreads(self.numberOfThreads.get(), nProcesses)
+
+  def getInferenceEnv(self):
+    '''Returns the package dictionary of the environment running the inference'''
+    return DIFFDOCK_CPU_DIC if self.cpuMode.get() and self.cpuEnv.get() else DIFFDOCK_DIC
+
+  def getNumberOfInputMols(self, upTo=None):
+    '''Returns the number of input molecules. For a library input, the count stops at upTo molecules if given'''
+    if not self.useLibrary.get():
+      if self.nInputMols.get() is None:
+        with self.openInputMols() as inputMols:
+          return len(inputMols)
+      return self.nInputMols.get()
+    return sum(1 for _ in itertools.islice(iterSmilesLibrary(self.inputLibrary.get()), upTo))
+
+  def getJobArray(self, coarse=False):
+    '''Returns the job array running the inference tasks: in the queue system if the protocol uses it, or in a local
+    pool of processes otherwise'''
+    jobsDir = self._getExtraPath('jobs_coarse' if coarse else 'jobs')
+    if self.useQueue():
+      return QueueJobArray(jobsDir, self.getHostConfig(), self.getSubmitDict())
+    return LocalJobArray(jobsDir, self.getNumberOfProcesses())
+
+  def getShardDir(self, shardIdx, coarse=False):
+    if coarse:
+      return os.path.join(self.getCoarseDir(), f'shard_{shardIdx}')
+    return os.path.abspath(self._getExtraPath(f'shard_{shardIdx}'))
+
+  def getRepresentatives(self):
+    '''Returns {title: representative title} for the input molecules. When deduplicating, the representative of the
+    molecules sharing the same SMILES is the first of their titles, and only the representatives are docked'''
+    if getattr(self, '_representatives', None) is None:
+      smiDic, firstTitles = self.getInputSMIs(), {}
+      if self.incremental.get():
+        # The molecules with the SMILES of a molecule docked in previous executions are not docked again
+        for title in sorted(self.getDockedTitles()):
+          firstTitles.setdefault(smiDic[title], title)
+      if self.deduplicate.get():
+        for title in sorted(smiDic):
+          firstTitles.setdefault(smiDic[title], title)
+      self._representatives = {title: firstTitles.get(smi, title) for title, smi in smiDic.items()}
+    return self._representatives
+
+  def getDockingTitles(self):
+    '''Returns the titles of the molecules to dock: the representatives not docked in previous executions'''
+    titles = set(self.getRepresentatives().values())
+    if self.incremental.get():
+      titles -= self.getDockedTitles()
+    return sorted(titles)
+
+  def getDockedTitlesFile(self):
+    return self._getExtraPath('dockedTitles.txt')
+
+  def writeDockedTitles(self):
+    '''Stores the titles of the input molecules docked on every receptor before the current execution, so the
+    molecules to dock do not change while the execution docks more of them. Only the poses merged by previous
+    executions count, so the molecules DiffDock failed on are docked again'''
+    dockedNames, recIds = self.getMergedNames(), self.getReceptorIds()
+    with open(self.getDockedTitlesFile(), 'w') as f:
+      for title in self.getInputSMIs():
+        if all(getComplexName(title, recId) in dockedNames for recId in recIds):
+          f.write(f'{title}\n')
+
+  def getDockedTitles(self):
+    if getattr(self, '_dockedTitles', None) is None:
+      with open(self.getDockedTitlesFile()) as f:
+        self._dockedTitles = set(f.read().split())
+    return self._dockedTitles
+
+  def getShardComplexes(self, shardIdx, coarse=False):
+    '''Returns the complexes of a shard. In the second stage of the progressive docking, the selected complexes are
+    split again among the shards'''
+    if self.progressive.get() and not coarse:
+      complexDic = self.getInputComplexes()
+      shardNames = splitInShards(self.getRefineComplexes(), self.getNumberOfShards())[shardIdx]
+      return {cName: complexDic[cName] for cName in shardNames}
+    shardTitles = splitInShards(self.getDockingTitles(), self.getNumberOfShards())[shardIdx]
+    return self.getInputComplexes(shardTitles)
+
+  def getInputCSV(self, shardIdx):
+    return os.path.abspath(self._getExtraPath(f'inputPairs_{shardIdx}.csv'))
 
-    with open(csvFile, 'w') as f:
-      f.write('complex_name,protein_path,ligand_description,protein_sequence\n')
-      for smi, title in smiDic.items():
-        f.write(f'{title},{iASFile},{smi},\n')
+  def buildCSVFile(self, shardIdx, complexDic):
+    '''Writes the DiffDock input csv file with the shard complexes {complexName: (receptorId, title, smiles)}'''
+    csvFile = self.getInputCSV(shardIdx)
+    writeInputCSV(csvFile, [(cName, self.getReceptorFile(recId), smi)
+                            for cName, (recId, _, smi) in complexDic.items()])
     return csvFile
@@ -0,0 +1,259 @@
+# **************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Wrapper of the DiffDock inference module. It must be run inside the DiffDock environment, with the DiffDock repository
+as working directory. Apart from the DiffDock inference arguments, it accepts:
+  --esm_cache_dir: directory where the ESM embeddings of the receptor chains are stored by sequence hash, so they are
+  only computed once for each distinct sequence
+  --precompute_esm: receptor pdb files whose chain embeddings are computed and stored in the cache, without running
+  any inference
+  --receptor_cache_dir: directory where the parsed receptor structures are stored by file content hash, so each
+  receptor is only parsed once. The receptor graphs are also kept in memory for the complexes of the same receptor
+  --threads: number of CPU threads used by torch in the process (intra-op), to avoid oversubscribing the cores when
+  several inference processes run at the same time
+The sampling time of each complex and the peak memory of the process are written in the inference output, in lines
+starting with DIFFDOCK_TIMING and DIFFDOCK_PEAK_RSS
+"""
+
+import argparse, contextlib, copy, hashlib, inspect, os, pickle, resource, runpy, sys, time, traceback
+
+ESM_MODEL = 'esm2_t33_650M_UR50D'
+# Keep in sync with diffdock.utils.metrics
+TIMING_TAG, PEAK_RSS_TAG = 'DIFFDOCK_TIMING', 'DIFFDOCK_PEAK_RSS'
+esmCacheDir, receptorCacheDir = None, None
+_receptorHashes, _parsedReceptors, _receptorGraphs = {}, {}, {}
+
+class LazyESMModel:
+  '''Placeholder returned instead of the ESM model, which is only loaded if some embedding is not in the cache'''
+  def eval(self):
+    return self
+
+  def cuda(self):
+    return self
+
+  def to(self, *args, **kwargs):
+    return self
+
+def getEmbeddingFile(sequence):
+  return os.path.join(esmCacheDir, hashlib.sha256(sequence.encode()).hexdigest() + '.pt')
+
+def useESMCache():
+  '''Patches the DiffDock ESM embedding computation so the embeddings are read from the cache when possible
+  and only the missing distinct sequences are computed'''
+  import torch
+  from esm import pretrained
+  from utils import inference_utils
+
+  if not hasattr(inference_utils, 'compute_ESM_embeddings'):
+    print('WARNING: ESM embedding computation not found in this DiffDock version, the cache will not be used')
+    return
+  computeEmbeddings, loadModel = inference_utils.compute_ESM_embeddings, pretrained.load_model_and_alphabet
+
+  def loadLazyModel(modelLocation):
+    return (LazyESMModel(), None) if modelLocation == ESM_MODEL and esmCacheDir else loadModel(modelLocation)
+
+  def cachedComputeEmbeddings(model, alphabet, labels, sequences):
+    if not esmCacheDir:
+      return computeEmbeddings(model, alphabet, labels, sequences)
+
+    missing = sorted({seq for seq in sequences if not os.path.exists(getEmbeddingFile(seq))})
+    if missing:
+      print(f'Computing ESM embeddings for {len(missing)} new sequences')
+      if isinstance(model, LazyESMModel):
+        model, alphabet = loadModel(ESM_MODEL)
+        model.eval()
+        if torch.cuda.is_available():
+          model = model.cuda()
+      newEmbeddings = computeEmbeddings(model, alphabet, [str(i) for i in range(len(missing))], missing)
+      os.makedirs(esmCacheDir, exist_ok=True)
+      for i, seq in enumerate(missing):
+        tmpFile = f'{getEmbeddingFile(seq)}.{os.getpid()}'
+        torch.save(newEmbeddings[str(i)], tmpFile)
+        os.replace(tmpFile, getEmbeddingFile(seq))
+
+    seqEmbeddings = {seq: torch.load(getEmbeddingFile(seq)) for seq in set(sequences)}
+    return {label: seqEmbeddings[seq] for label, seq in zip(labels, sequences)}
+
+  pretrained.load_model_and_alphabet = loadLazyModel
+  inference_utils.compute_ESM_embeddings = cachedComputeEmbeddings
+
+def timeSampling():
+  '''Patches the DiffDock sampling function, called once per complex, to print its duration'''
+  from utils import sampling
+  if getattr(sampling.sampling, 'timed', False):
+    return
+  runSampling = sampling.sampling
+
+  def timedSampling(data_list, *args, **kwargs):
+    start = time.time()
+    try:
+      return runSampling(data_list, *args, **kwargs)
+    finally:
+      name = data_list[0]['name'] if data_list else 'unknown'
+      name = name[0] if isinstance(name, (list, tuple)) else name
+      print(f'{TIMING_TAG} {name} {time.time() - start:.3f}', flush=True)
+
+  timedSampling.timed = True
+  sampling.sampling = timedSampling
+
+def getReceptorHash(pdbFile):
+  '''Returns the sha256 hex digest of the content of a receptor file, memoized by its path and modification time'''
+  statKey = (os.path.abspath(pdbFile), os.path.getmtime(pdbFile), os.path.getsize(pdbFile))
+  if statKey not in _receptorHashes:
+    with open(pdbFile, 'rb') as f:
+      _receptorHashes[statKey] = hashlib.sha256(f.read()).hexdigest()
+  return _receptorHashes[statKey]
+
+def useReceptorCache():
+  '''Patches the DiffDock receptor parsing so each receptor file content is parsed once, storing the parsed structure
+  in the receptor cache, and the receptor graph construction (if this DiffDock version builds it independently of the
+  ligand) so it is done once per receptor and parameters'''
+  import torch
+  from datasets import process_mols
+  from utils import inference_utils
+
+  parsePDB = getattr(process_mols, 'parse_pdb_from_path', None)
+  if parsePDB is not None:
+    def cachedParsePDB(path):
+      key = getReceptorHash(path)
+      if key not in _parsedReceptors:
+        cacheFile = os.path.join(receptorCacheDir, f'{key}.pkl') if receptorCacheDir else None
+        if cacheFile and os.path.exists(cacheFile):
+          with open(cacheFile, 'rb') as f:
+            _parsedReceptors[key] = f.read()
+        else:
+          try:
+            _parsedReceptors[key] = pickle.dumps(parsePDB(path))
+          except pickle.PicklingError:
+            return parsePDB(path)
+          if cacheFile:
+            os.makedirs(receptorCacheDir, exist_ok=True)
+            with open(f'{cacheFile}.{os.getpid()}', 'wb') as f:
+              f.write(_parsedReceptors[key])
+            os.replace(f'{cacheFile}.{os.getpid()}', cacheFile)
+      return pickle.loads(_parsedReceptors[key])
+
+    # The modules importing the function keep their own reference to it
+    modules = [process_mols, inference_utils]
+    with contextlib.suppress(ImportError):
+      from datasets import pdbbind
+      modules.append(pdbbind)
+    for module in modules:
+      if hasattr(module, 'parse_pdb_from_path'):
+        module.parse_pdb_from_path = cachedParsePDB
+
+  extractReceptor = getattr(inference_utils, 'moad_extract_receptor_structure', None)
+  if extractReceptor is not None:
+    from torch_geometric.data import HeteroData
+    signature = inspect.signature(extractReceptor)
+
+    def copyValue(value):
+      return value.clone() if torch.is_tensor(value) else copy.deepcopy(value)
+
+    def cachedExtractReceptor(*args, **kwargs):
+      arguments = signature.bind(*args, **kwargs).arguments
+      complexGraph = arguments.pop('complex_graph')
+      lmEmbeddings = arguments.pop('lm_embeddings', None)
+      key = (getReceptorHash(arguments.pop('path')), lmEmbeddings is None, repr(sorted(arguments.items())))
+      if key not in _receptorGraphs:
+        receptorGraph = HeteroData()
+        output = extractReceptor(**dict(signature.bind(*args, **kwargs).arguments, complex_graph=receptorGraph))
+        _receptorGraphs[key] = (receptorGraph, output)
+
+      receptorGraph, output = _receptorGraphs[key]
+      for storeKey in receptorGraph.node_types + receptorGraph.edge_types:
+        for attrName, value in receptorGraph[storeKey].items():
+          complexGraph[storeKey][attrName] = copyValue(value)
+      return copyValue(output)
+
+    inference_utils.moad_extract_receptor_structure = cachedExtractReceptor
+
+def precomputeEmbeddings(pdbFiles):
+  from utils import inference_utils
+  sequences = []
+  for pdbFile in pdbFiles:
+    sequences += inference_utils.get_sequences_from_pdbfile(pdbFile).split(':')
+  inference_utils.compute_ESM_embeddings(LazyESMModel(), None, [str(i) for i in range(len(sequences))], sequences)
+
+def setThreads(nThreads):
+  '''Limits the CPU threads used by torch. The inter-op pool is kept to one thread, as the inference runs its
+  operations sequentially, so the process uses nThreads cores'''
+  import torch
+  torch.set_num_threads(nThreads)
+  with contextlib.suppress(RuntimeError):
+    # It can only be set before any parallel work is done in the process
+    torch.set_num_interop_threads(1)
+
+def runInference(argv, logFile=None, cacheDir=None, recCacheDir=None, nThreads=None):
+  '''Runs the DiffDock inference module as if called from command line. Returns its exit code'''
+  global esmCacheDir, receptorCacheDir
+  oldArgv, esmCacheDir, receptorCacheDir = sys.argv, cacheDir, recCacheDir
+  if nThreads:
+    setThreads(nThreads)
+  with contextlib.ExitStack() as stack:
+    if logFile:
+      log = stack.enter_context(open(logFile, 'a'))
+      stack.enter_context(contextlib.redirect_stdout(log))
+      stack.enter_context(contextlib.redirect_stderr(log))
+    try:
+      sys.argv = ['inference.py'] + list(argv)
+      timeSampling()
+      runpy.run_module('inference', run_name='__main__')
+      returnCode = 0
+    except SystemExit as e:
+      returnCode = e.code if isinstance(e.code, int) else 1
+    except Exception:
+      traceback.print_exc()
+      returnCode = 1
+    finally:
+      sys.argv = oldArgv
+      print(f'{PEAK_RSS_TAG} {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}', flush=True)
+  return returnCode
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description='Runs DiffDock inference reusing cached ESM embeddings')
+  parser.add_argument('--esm_cache_dir', default=None, help='Directory of the ESM embeddings cache')
+  parser.add_argument('--precompute_esm', nargs='+', default=None,
+                      help='Only compute and store the embeddings of these receptor files')
+  parser.add_argument('--receptor_cache_dir', default=None, help='Directory of the parsed receptors cache')
+  parser.add_argument('--threads', type=int, default=None, help='Number of CPU threads used by torch')
+  args, inferenceArgs = parser.parse_known_args()
+
+  sys.path.insert(0, os.getcwd())
+  if args.esm_cache_dir:
+    useESMCache()
+  if args.receptor_cache_dir:
+    useReceptorCache()
+
+  if args.precompute_esm:
+    esmCacheDir = args.esm_cache_dir
+    if args.threads:
+      setThreads(args.threads)
+    precomputeEmbeddings(args.precompute_esm)
+  else:
+    sys.exit(runInference(inferenceArgs, cacheDir=args.esm_cache_dir, recCacheDir=args.receptor_cache_dir,
+                          nThreads=args.threads))
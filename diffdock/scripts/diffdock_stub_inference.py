@@ -0,0 +1,106 @@
+# **************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Stand-in of the DiffDock inference module for benchmarks and tests of the plugin pipeline. It accepts the DiffDock
+inference arguments and, for each complex of the input csv, writes the ranked pose files DiffDock would generate
+(rankN_confidenceC.sdf and rank1.sdf) with random coordinates, without any model or GPU.
+As DiffDock, it creates the output directory of every complex before docking them, so the complexes it fails on are
+left with an empty directory. The poses of each complex are deterministic given the seed and the complex name
+"""
+
+import argparse, csv, os, random, re, sys, time
+
+# Keep in sync with diffdock.utils.metrics
+TIMING_TAG = 'DIFFDOCK_TIMING'
+ATOM_REGEX = re.compile(r'Cl|Br|[BCNOPSFIbcnops]')
+
+def buildMolBlock(name, elements, rng):
+  '''Returns an sdf record of a chain molecule with the given elements and random coordinates'''
+  nAtoms = len(elements)
+  lines = [name, '  DiffDockStub', '', f'{nAtoms:>3}{max(0, nAtoms - 1):>3}  0  0  0  0  0  0  0  0999 V2000']
+  for element in elements:
+    x, y, z = (rng.uniform(-10, 10) for _ in range(3))
+    lines.append(f'{x:>10.4f}{y:>10.4f}{z:>10.4f} {element.capitalize():<3} 0  0  0  0  0  0  0  0  0  0  0  0')
+  for i in range(1, len(elements)):
+    lines.append(f'{i:>3}{i + 1:>3}  1  0')
+  lines += ['M  END', '$$$$', '']
+  return '\n'.join(lines)
+
+def writeComplexPoses(outDir, cName, smi, nSamples, seed):
+  '''Writes the ranked poses of a complex in its output directory'''
+  rng = random.Random(f'{seed}_{cName}')
+  elements = ATOM_REGEX.findall(smi) or ['C']
+  confidences = sorted((rng.gauss(-0.5, 1.0) for _ in range(nSamples)), reverse=True)
+  complexDir = os.path.join(outDir, cName)
+  os.makedirs(complexDir, exist_ok=True)
+  for rank, conf in enumerate(confidences, start=1):
+    molBlock = buildMolBlock(cName, elements, rng)
+    with open(os.path.join(complexDir, f'rank{rank}_confidence{conf:.2f}.sdf'), 'w') as f:
+      f.write(molBlock)
+    if rank == 1:
+      with open(os.path.join(complexDir, 'rank1.sdf'), 'w') as f:
+        f.write(molBlock)
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description='Writes random DiffDock-like outputs for the complexes of a csv')
+  parser.add_argument('--protein_ligand_csv', required=True)
+  parser.add_argument('--out_dir', required=True)
+  parser.add_argument('--samples_per_complex', type=int, default=10)
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--delay', type=float, default=0.0, help='Seconds to wait for each complex')
+  parser.add_argument('--fail_fraction', type=float, default=0.0,
+                      help='Fraction of the complexes (chosen at random) with no output, as if DiffDock failed')
+  parser.add_argument('--fail_names', default=None,
+                      help='Regular expression of the names of the complexes with no output')
+  parser.add_argument('--interrupt_file', default=None,
+                      help='If this file does not exist, it is created and the inference exits with an error after '
+                           'docking half of the complexes, as if it was interrupted')
+  args, _ = parser.parse_known_args()
+
+  with open(args.protein_ligand_csv) as f:
+    rows = list(csv.DictReader(f))
+  for row in rows:
+    os.makedirs(os.path.join(args.out_dir, row['complex_name']), exist_ok=True)
+
+  nDocked = len(rows)
+  if args.interrupt_file and not os.path.exists(args.interrupt_file):
+    open(args.interrupt_file, 'w').close()
+    nDocked = len(rows) // 2
+  failRng = random.Random(args.seed)
+  for row in rows[:nDocked]:
+    start = time.time()
+    if args.delay:
+      time.sleep(args.delay)
+    failed = failRng.random() < args.fail_fraction
+    if failed or (args.fail_names and re.search(args.fail_names, row['complex_name'])):
+      print(f'Failed on {row["complex_name"]}')
+      continue
+    writeComplexPoses(args.out_dir, row['complex_name'], row['ligand_description'], args.samples_per_complex,
+                      args.seed)
+    print(f'{TIMING_TAG} {row["complex_name"]} {time.time() - start:.3f}')
+  if nDocked < len(rows):
+    sys.exit(f'Inference interrupted after {nDocked} of {len(rows)} complexes')
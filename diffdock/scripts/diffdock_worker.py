@@ -0,0 +1,99 @@
+# **************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Persistent DiffDock inference worker. It must be run inside the DiffDock environment, with the DiffDock repository as
+working directory. The heavy libraries are imported once and the model checkpoints and ESM language models are kept in
+memory, so each request only pays for the docking itself. Requests are served one at a time through a local socket:
+  {'command': 'ping'} / {'command': 'stop'} /
+  {'command': 'inference', 'argv': [...], 'logFile': path, 'esmCacheDir': path or None,
+   'receptorCacheDir': path or None}
+The parsed receptors and receptor graphs are also kept in memory between requests.
+"""
+
+import argparse, functools, os, sys
+from multiprocessing.connection import Listener
+
+from diffdock_inference import runInference, useESMCache, useReceptorCache
+
+def memoizeLoaders():
+  '''Keeps in memory the checkpoints and ESM models loaded by the DiffDock inference'''
+  import torch
+  from esm import pretrained
+
+  torchLoad, esmLoad = torch.load, pretrained.load_model_and_alphabet
+  checkpoints = {}
+
+  def cachedTorchLoad(f, *args, **kwargs):
+    if not isinstance(f, str):
+      return torchLoad(f, *args, **kwargs)
+    key = (os.path.abspath(f), os.path.getmtime(f), str(kwargs.get('map_location')))
+    if key not in checkpoints:
+      checkpoints[key] = torchLoad(f, *args, **kwargs)
+    return checkpoints[key]
+
+  torch.load = cachedTorchLoad
+  pretrained.load_model_and_alphabet = functools.lru_cache(maxsize=None)(esmLoad)
+
+def serve(address, authkey):
+  if os.path.exists(address):
+    os.remove(address)
+
+  with Listener(address, family='AF_UNIX', authkey=authkey) as listener:
+    print(f'DiffDock worker listening on {address}', flush=True)
+    while True:
+      with listener.accept() as con:
+        request = con.recv()
+        command = request.get('command')
+        if command == 'ping':
+          con.send({'returncode': 0})
+        elif command == 'stop':
+          con.send({'returncode': 0})
+          break
+        elif command == 'inference':
+          returnCode = runInference(request['argv'], request['logFile'], request.get('esmCacheDir'),
+                                    request.get('receptorCacheDir'))
+          con.send({'returncode': returnCode})
+        else:
+          con.send({'returncode': 1, 'error': f'Unknown command {command}'})
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description='Persistent DiffDock inference worker')
+  parser.add_argument('--address', required=True, help='Unix socket path the worker listens on')
+  parser.add_argument('--authkeyFile', required=True, help='File containing the authentication key of the socket')
+  args = parser.parse_args()
+
+  sys.path.insert(0, os.getcwd())
+  memoizeLoaders()
+  useESMCache()
+  useReceptorCache()
+  with open(args.authkeyFile, 'rb') as f:
+    authkey = f.read()
+  try:
+    serve(args.address, authkey)
+  finally:
+    if os.path.exists(args.address):
+      os.remove(args.address)
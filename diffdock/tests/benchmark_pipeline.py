@@ -0,0 +1,161 @@
+# **************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Benchmark of the DiffDock plugin pipeline overhead: building the input csv files, parsing the output pose trees,
+filtering and packing the poses and creating the output set, on synthetic libraries of ligands. The DiffDock
+inference is replaced by a stub (scripts/diffdock_stub_inference.py) writing realistic pose trees, so neither a GPU
+nor a DiffDock installation is needed. Run it inside the Scipion environment:
+  python -m diffdock.tests.benchmark_pipeline --sizes 1000 10000 --output results.json
+Note that each ligand generates nSamples + 1 files, so big libraries need plenty of disk space and inodes
+"""
+
+import argparse, json, os, random, resource, shutil, subprocess, sys, tempfile, time
+from concurrent.futures import ThreadPoolExecutor
+
+from ..utils import splitInShards, writeInputCSV, mergeShardOutputs, indexOutputDocks, filterPoses, writeManifest, \
+  readManifest, packPoses, appendPoses, getComplexName
+
+STUB_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'scripts', 'diffdock_stub_inference.py')
+FRAGMENTS = ['C', 'CC', 'C(C)', 'c1ccccc1', 'N', 'O', 'C(=O)O', 'C(=O)N', 'Cl', 'F', 'S', 'c1ccncc1']
+
+def buildLibrary(nLigands, seed=0):
+  '''Returns a reproducible synthetic library {title: smiles} of nLigands'''
+  rng = random.Random(seed)
+  return {f'lig{i}': ''.join(rng.choice(FRAGMENTS) for _ in range(rng.randint(4, 12))) for i in range(nLigands)}
+
+def runStage(results, stageName, nItems, func, *args):
+  '''Runs a stage of the pipeline, storing its wall time, CPU time, throughput and process peak memory in results.
+  Returns the output of the stage'''
+  startWall, startUsage = time.time(), resource.getrusage(resource.RUSAGE_SELF)
+  output = func(*args)
+  wallTime, endUsage = time.time() - startWall, resource.getrusage(resource.RUSAGE_SELF)
+  results[stageName] = {'wallTime': wallTime,
+                        'cpuTime': endUsage.ru_utime + endUsage.ru_stime - startUsage.ru_utime - startUsage.ru_stime,
+                        'itemsPerSecond': nItems / wallTime if wallTime > 0 else None,
+                        'peakRSS': endUsage.ru_maxrss / 1024}
+  return output
+
+def buildCSVFiles(workDir, library, nShards):
+  csvFiles, recFile = [], os.path.join(workDir, 'receptor.pdb')
+  for shardIdx, titles in enumerate(splitInShards(sorted(library), nShards)):
+    csvFiles.append(os.path.join(workDir, f'inputPairs_{shardIdx}.csv'))
+    writeInputCSV(csvFiles[-1], [(getComplexName(title), recFile, library[title]) for title in titles])
+  return csvFiles
+
+def runStubInference(csvFiles, outDir, nSamples, seed):
+  def runShard(shardIdx):
+    shardDir = os.path.join(outDir, f'shard_{shardIdx}')
+    subprocess.run([sys.executable, STUB_SCRIPT, '--protein_ligand_csv', csvFiles[shardIdx], '--out_dir', shardDir,
+                    '--samples_per_complex', str(nSamples), '--seed', str(seed)],
+                   check=True, stdout=subprocess.DEVNULL)
+    return shardDir
+
+  with ThreadPoolExecutor(len(csvFiles)) as executor:
+    return list(executor.map(runShard, range(len(csvFiles))))
+
+def mergeShards(shardDirs, outDir):
+  for shardDir in shardDirs:
+    mergeShardOutputs(shardDir, outDir)
+
+def filterAndWriteManifest(poseIndex, manifestFile, keepTopK):
+  writeManifest(manifestFile, {cName: filterPoses(poses, keepTopK)[0] for cName, poses in poseIndex.items()})
+  return readManifest(manifestFile)
+
+def createOutputSet(workDir, library, poseIndex):
+  '''Creates the output set of small molecules of the poses index with the registration of the docking protocol,
+  reusing a template molecule for the poses of each ligand. Returns the number of poses in the set'''
+  import pyworkflow.object as pwobj
+  from pwchem.objects import SetOfSmallMolecules, SmallMolecule
+
+  outputSet, nPoses = SetOfSmallMolecules(filename=os.path.join(workDir, 'outputSmallMolecules.sqlite')), 0
+  for title in library:
+    template = SmallMolecule(smallMolFilename=os.path.join(workDir, f'{title}.sdf'))
+    template._energy, template._poseOffset = pwobj.Float(), pwobj.Integer()
+    template.gridId.set(1)
+    template.setMolClass('DiffDock')
+    nPoses = appendPoses(outputSet, template, poseIndex.get(getComplexName(title), []), nPoses)
+  outputSet.write()
+  outputSet.close()
+  return nPoses
+
+def runBenchmark(nLigands, workDir, nSamples=5, nShards=4, keepTopK=0, pack=False, seed=0):
+  '''Runs the pipeline on a synthetic library of nLigands in workDir. Returns the metrics of each stage'''
+  results = {}
+  outDir = os.path.join(workDir, 'extra')
+  os.makedirs(outDir, exist_ok=True)
+  nPoses = nLigands * nSamples
+
+  library = runStage(results, 'buildLibrary', nLigands, buildLibrary, nLigands, seed)
+  csvFiles = runStage(results, 'buildCSV', nLigands, buildCSVFiles, workDir, library, nShards)
+  shardDirs = runStage(results, 'stubInference', nLigands, runStubInference, csvFiles, outDir, nSamples, seed)
+  runStage(results, 'mergeShards', nLigands, mergeShards, shardDirs, outDir)
+  poseIndex = runStage(results, 'parseOutputs', nPoses, indexOutputDocks, outDir)
+  poseIndex = runStage(results, 'filterPoses', nPoses, filterAndWriteManifest, poseIndex,
+                       os.path.join(workDir, 'outputManifest.tsv'), keepTopK)
+  results['filterPoses']['nPoses'] = sum(len(poses) for poses in poseIndex.values())
+  if pack:
+    poseIndex = runStage(results, 'packPoses', nPoses, packPoses, poseIndex, os.path.join(workDir, 'outputPoses.sdf'))
+  try:
+    nSetPoses = runStage(results, 'createSet', nPoses, createOutputSet, workDir, library, poseIndex)
+    results['createSet']['nPoses'] = nSetPoses
+  except ImportError as e:
+    print(f'Skipping the output set creation, Scipion packages not available: {e}')
+  return results
+
+def printResults(nLigands, results):
+  print(f'\n{nLigands} ligands')
+  print(f'{"stage":<15}{"wall (s)":>10}{"cpu (s)":>10}{"items/s":>12}{"peak RSS (MB)":>15}')
+  for stageName, stageMetrics in results.items():
+    itemsPerSecond = stageMetrics['itemsPerSecond'] or 0
+    print(f'{stageName:<15}{stageMetrics["wallTime"]:>10.2f}{stageMetrics["cpuTime"]:>10.2f}'
+          f'{itemsPerSecond:>12.0f}{stageMetrics["peakRSS"]:>15.0f}')
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description='Benchmarks the DiffDock plugin pipeline with a stub inference')
+  parser.add_argument('--sizes', type=int, nargs='+', default=[1000], help='Number of ligands of each library')
+  parser.add_argument('--samples', type=int, default=5, help='Poses generated per ligand')
+  parser.add_argument('--shards', type=int, default=4, help='Number of parallel inference shards')
+  parser.add_argument('--keepTopK', type=int, default=0, help='Poses kept per ligand (0 keeps all)')
+  parser.add_argument('--pack', action='store_true', help='Pack the poses in a single sdf file')
+  parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic library and poses')
+  parser.add_argument('--workDir', default=None, help='Directory for the benchmark files (removed afterwards)')
+  parser.add_argument('--output', default=None, help='Json file to store the results')
+  args = parser.parse_args()
+
+  allResults = {}
+  for nLigands in args.sizes:
+    workDir = tempfile.mkdtemp(prefix=f'diffdockBench_{nLigands}_', dir=args.workDir)
+    try:
+      allResults[nLigands] = runBenchmark(nLigands, workDir, args.samples, args.shards, args.keepTopK, args.pack,
+                                          args.seed)
+    finally:
+      shutil.rmtree(workDir)
+    printResults(nLigands, allResults[nLigands])
+
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump({'parameters': vars(args), 'results': allResults}, f, indent=2)
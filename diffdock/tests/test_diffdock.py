@@ -24,12 +24,22 @@
 # *
 # **************************************************************************
 
+import glob, gzip, os, shutil, subprocess, sys, tempfile, time, unittest
+from collections import Counter
+
 from pyworkflow.tests import BaseTest, setupTestProject, DataSet
 from pwem.protocols import ProtImportPdb, ProtSetFilter
 
 from pwchem.protocols import ProtChemImportSmallMolecules
 
+from ..constants import DIFFDOCK_INFERENCE_VAR
 from ..protocols import ProtDiffDockDocking
+from ..utils import splitInShards, indexOutputDocks, writeManifest, readManifest, indexManifest, readManifestPoses, \
+  mergeShardOutputs, filterPoses, packPoses, readPoseRecord, countHeavyAtoms, estimateBatchSize, cropStructure, \
+  PoseCache, getCacheKey, measureResources, appendMetrics, readMetrics, parseInferenceLog, summarizeMetrics, \
+  LocalJobArray, clusterPoses, iterSmilesLibrary, cleanReceptorPDB, splitThreads, getThreadsEnviron, PoseSummary, \
+  isOutOfMemoryLog, getLoggedArgs, TIMING_TAG
+from .benchmark_pipeline import runBenchmark, STUB_SCRIPT
 
 class TestDiffDock(BaseTest):
   @classmethod
@@ -68,12 +78,12 @@ class TestDiffDock(BaseTest):
     self.proj.launchProtocol(self.protFilter, wait=False)
     return self.protFilter
 
-  def _runDiffDock(self, recProt, ligProt):
+  def _runDiffDock(self, recProt, ligProt, **kwargs):
     protDiffDock = self.newProtocol(
     ProtDiffDockDocking,
     inputAtomStruct=recProt.outputPdb,
     inputSmallMols=ligProt.outputSmallMolecules,
-    nSamples=5, inferSteps=10)
+    nSamples=5, inferSteps=10, **kwargs)
     self.proj.launchProtocol(protDiffDock, wait=False)
 
     return protDiffDock
@@ -88,3 +98,279 @@ class TestDiffDock(BaseTest):
     self._waitOutput(protDiffDock, 'outputSmallMolecules', sleepTime=10)
     self.assertIsNotNone(getattr(protDiffDock, 'outputSmallMolecules', None))
 
+  def testProgressive(self):
+    protSmallFilter = self._runSetFilter(inProt=self.protImportSmallMols, number=2, property='smallMoleculeFile')
+    self._waitOutput(protSmallFilter, 'outputSmallMolecules', sleepTime=10)
+
+    print('Docking with DiffDock in two stages, refining one of the two ligands')
+    protDiffDock = self._runDiffDock(self.protImportPDB, protSmallFilter, progressive=True, coarseSamples=2,
+                                     coarseSteps=5, refineFraction=0.5)
+
+    self._waitOutput(protDiffDock, 'outputSmallMolecules', sleepTime=10)
+    # The refined ligand keeps its second stage poses and the other one its first stage poses
+    posesPerLigand = Counter(os.path.basename(mol.getFileName()) for mol in protDiffDock.outputSmallMolecules)
+    self.assertEqual(sorted(posesPerLigand.values()), [2, 5])
+
+  def testStubPipeline(self):
+    '''Runs the protocol on a SMILES library with the stub inference, so DiffDock is not needed: the first execution
+    is interrupted and continued, the poses are streamed and packed, the duplicated molecule gets the poses of its
+    representative and the ligand the stub fails on is reported'''
+    tmpDir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, tmpDir)
+    libraryFile = os.path.join(tmpDir, 'library.smi')
+    with open(libraryFile, 'w') as f:
+      f.write('CCO ethanol\nCCO ethanol_copy\nCCN ethylamine\nCC(=O)O acetic_acid\nc1ccccc1 benzene\nCCCl failing\n')
+    os.environ[DIFFDOCK_INFERENCE_VAR] = f'{sys.executable} {STUB_SCRIPT} --fail_names failing ' \
+                                         f'--interrupt_file {os.path.join(tmpDir, "interrupted")}'
+    self.addCleanup(os.environ.pop, DIFFDOCK_INFERENCE_VAR)
+
+    protDiffDock = self.newProtocol(
+      ProtDiffDockDocking,
+      inputAtomStruct=self.protImportPDB.outputPdb, useLibrary=True, inputLibrary=libraryFile,
+      nSamples=3, cacheESM=False, useCache=False, streamOutput=True, packOutput=True)
+    self.proj.launchProtocol(protDiffDock, wait=True)
+    self.assertTrue(protDiffDock.isFailed())
+    print('Continuing the interrupted docking')
+    self.proj.launchProtocol(protDiffDock, wait=True)
+    self.assertFalse(protDiffDock.isFailed())
+
+    posesPerLigand = Counter(os.path.basename(mol.getFileName()) for mol in protDiffDock.outputSmallMolecules)
+    self.assertEqual(posesPerLigand, {f'{title}.smi': 3 for title in
+                                      ['ethanol', 'ethanol_copy', 'ethylamine', 'acetic_acid', 'benzene']})
+    self.assertEqual(protDiffDock.nFailed.get(), 1)
+    with open(protDiffDock.getFailedFile()) as f:
+      self.assertEqual(f.read().split(), ['failing'])
+    # Each unique molecule is docked once: the complexes docked before the interruption are not docked again
+    nDocked = 0
+    for logFile in glob.glob(protDiffDock._getExtraPath('inference_*.log')):
+      with open(logFile) as f:
+        nDocked += sum(1 for line in f if line.startswith(TIMING_TAG))
+    self.assertEqual(nDocked, 4)
+
+
+
+class TestDiffDockUtils(unittest.TestCase):
+  def getTmpDir(self):
+    tmpDir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, tmpDir)
+    return tmpDir
+
+  def testSplitInShards(self):
+    shards = splitInShards(range(10), 3)
+    self.assertEqual([len(s) for s in shards], [4, 3, 3])
+    self.assertEqual(sum(shards, []), list(range(10)))
+    self.assertEqual(splitInShards(['a'], 2), [['a'], []])
+
+  def testIndexOutputDocks(self):
+    tmpDir = self.getTmpDir()
+    os.makedirs(os.path.join(tmpDir, 'lig1'))
+    os.makedirs(os.path.join(tmpDir, 'lig2'))
+    for fileName in ['rank1.sdf', 'rank1_confidence0.35.sdf', 'rank2_confidence-1.20.sdf']:
+      open(os.path.join(tmpDir, 'lig1', fileName), 'w').close()
+
+    index = indexOutputDocks(tmpDir)
+    self.assertEqual([(rank, conf) for rank, conf, _ in index['lig1']], [(1, 0.35), (2, -1.2)])
+    self.assertEqual(index['lig2'], [])
+
+    manifestFile = os.path.join(tmpDir, 'manifest.tsv')
+    writeManifest(manifestFile, index)
+    self.assertEqual(readManifest(manifestFile), {'lig1': index['lig1']})
+
+    writeManifest(manifestFile, {'lig3': index['lig1'][:1]}, append=True)
+    offsets = indexManifest(manifestFile)
+    self.assertEqual(set(offsets), {'lig1', 'lig3'})
+    with open(manifestFile, 'rb') as f:
+      self.assertEqual(readManifestPoses(f, offsets['lig1'], 'lig1'), index['lig1'])
+      self.assertEqual(readManifestPoses(f, offsets['lig3'], 'lig3'), index['lig1'][:1])
+
+  def testMergeShardOutputs(self):
+    tmpDir = self.getTmpDir()
+    coarseDir, outDir = os.path.join(tmpDir, 'coarse'), os.path.join(tmpDir, 'out')
+    for cName, outFiles, coarseFiles in [('lig1', ['rank1_confidence0.90.sdf'], ['rank1_confidence0.10.sdf']),
+                                         ('lig2', [], ['rank1_confidence0.20.sdf'])]:
+      os.makedirs(os.path.join(outDir, cName))
+      os.makedirs(os.path.join(coarseDir, cName))
+      for dirName, fileNames in [(outDir, outFiles), (coarseDir, coarseFiles)]:
+        for fileName in fileNames:
+          open(os.path.join(dirName, cName, fileName), 'w').close()
+
+    # The refined poses are kept and the complexes without them take the coarse ones
+    mergeShardOutputs(coarseDir, outDir, overwrite=False)
+    index = indexOutputDocks(outDir)
+    self.assertEqual([conf for _, conf, _ in index['lig1']], [0.9])
+    self.assertEqual([conf for _, conf, _ in index['lig2']], [0.2])
+    self.assertFalse(os.path.exists(coarseDir))
+
+  def testPoseSummary(self):
+    tmpDir = self.getTmpDir()
+    manifestFile, summaryFile = os.path.join(tmpDir, 'manifest.tsv'), os.path.join(tmpDir, 'summary.sqlite')
+    writeManifest(manifestFile, {'ligA': [(1, 0.5, 'a1.sdf'), (2, -1.5, 'a2.sdf')], 'ligB': [(1, 1.2, 'b1.sdf')]})
+
+    summary = PoseSummary(summaryFile)
+    summary.build(manifestFile)
+    self.assertEqual(summary.count(), 2)
+    firstPage = summary.getPage(1, 1)
+    self.assertEqual(firstPage[0]['complex'], 'ligB')
+    ligA = summary.getComplex('ligA')
+    self.assertEqual((ligA['nPoses'], ligA['confidenceRange']), (2, 2.0))
+    with open(manifestFile, 'rb') as f:
+      self.assertEqual(len(readManifestPoses(f, ligA['manifestOffset'], 'ligA')), 2)
+    self.assertEqual(sum(count for _, _, count in summary.getHistogram('all')), 3)
+
+  def testFilterPoses(self):
+    poses = [(1, 0.5, 'a'), (2, -0.3, 'b'), (3, -2.1, 'c')]
+    kept, dropped = filterPoses(poses, keepTopK=2, minConfidence=-1)
+    self.assertEqual(kept, poses[:2])
+    self.assertEqual(dropped, poses[2:])
+    self.assertEqual(filterPoses(poses, keepTopK=0, minConfidence=0)[0], poses[:1])
+
+  def testPackPoses(self):
+    tmpDir = self.getTmpDir()
+    records = ['lig\n  RDKit\n\nM  END\n$$$$\n', 'lig\n  RDKit\n\nM  END\n']
+    poses = []
+    for i, record in enumerate(records):
+      poseFile = os.path.join(tmpDir, f'rank{i+1}_confidence0.00.sdf')
+      with open(poseFile, 'w') as f:
+        f.write(record)
+      poses.append((i+1, 0.0, poseFile))
+
+    packedIndex = packPoses({'lig': poses}, os.path.join(tmpDir, 'packed.sdf'))
+    self.assertEqual([readPoseRecord(poseRef) for _, _, poseRef in packedIndex['lig']],
+                     [records[0], records[1] + '$$$$\n'])
+
+  def testBatchSizeEstimation(self):
+    self.assertEqual(countHeavyAtoms('C[C@H](N)C(=O)O'), 6)
+    self.assertEqual(countHeavyAtoms('[2H]OC(Cl)c1ccccc1'), 9)
+    self.assertEqual(estimateBatchSize(100, 30, 20), 1)
+    self.assertEqual(estimateBatchSize(10 ** 6, 30, 20), 20)
+
+  def testOutOfMemoryLog(self):
+    logFile = os.path.join(self.getTmpDir(), 'inference.log')
+    with open(logFile, 'w') as f:
+      f.write('Failed on 1abc_lig1 CUDA out of memory. Tried to allocate 2.00 GiB\n')
+    offset = os.path.getsize(logFile)
+    self.assertTrue(isOutOfMemoryLog(logFile))
+    self.assertFalse(isOutOfMemoryLog(logFile, offset))
+
+    # A process killed by the OOM killer writes nothing, only its exit code is logged
+    args = getLoggedArgs('-c "import os, signal; os.kill(os.getpid(), signal.SIGKILL)"', logFile)
+    self.assertEqual(subprocess.run(f'python {args}', shell=True).returncode, 137)
+    self.assertTrue(isOutOfMemoryLog(logFile, offset))
+
+  def testCropStructure(self):
+    tmpDir = self.getTmpDir()
+    pdbFile, cropFile = os.path.join(tmpDir, 'rec.pdb'), os.path.join(tmpDir, 'crop.pdb')
+    with open(pdbFile, 'w') as f:
+      f.write('ATOM      1  N   ALA A   1       0.000   0.000   0.000  1.00  0.00           N\n'
+              'ATOM      2  CA  ALA A   1      30.000   0.000   0.000  1.00  0.00           C\n'
+              'ATOM      3  N   GLY A   2      50.000   0.000   0.000  1.00  0.00           N\n')
+
+    cropStructure(pdbFile, (1, 0, 0), 5, cropFile)
+    with open(cropFile) as f:
+      cropLines = f.readlines()
+    self.assertEqual(len(cropLines), 3)
+    self.assertTrue(all(' ALA ' in line for line in cropLines[:2]))
+
+  def testSplitThreads(self):
+    self.assertEqual(splitThreads(16, 4), 4)
+    self.assertEqual(splitThreads(4, 8), 1)
+    environ = getThreadsEnviron(splitThreads(8, 3), cpuOnly=True)
+    self.assertEqual(environ['OMP_NUM_THREADS'], '2')
+    self.assertEqual(environ['CUDA_VISIBLE_DEVICES'], '')
+
+  def testCleanReceptorPDB(self):
+    tmpDir = self.getTmpDir()
+    pdbFile, cleanFile = os.path.join(tmpDir, 'rec.pdb'), os.path.join(tmpDir, 'clean.pdb')
+    with open(pdbFile, 'w') as f:
+      f.write('MODEL        1\n'
+              'ATOM      1  N  AALA A   1       0.000   0.000   0.000  0.60  0.00           N\n'
+              'ATOM      2  N  BALA A   1       0.100   0.000   0.000  0.40  0.00           N\n'
+              'HETATM    3  O   HOH A 101       5.000   0.000   0.000  1.00  0.00           O\n'
+              'ENDMDL\n'
+              'MODEL        2\n'
+              'ATOM      1  N   ALA A   1       9.000   0.000   0.000  1.00  0.00           N\n')
+
+    cleanReceptorPDB(pdbFile, cleanFile)
+    with open(cleanFile) as f:
+      cleanLines = f.readlines()
+    self.assertEqual(len(cleanLines), 2)
+    self.assertTrue(cleanLines[0].startswith('ATOM      1  N   ALA A   1       0.000'))
+
+  def testPoseCacheEviction(self):
+    tmpDir = self.getTmpDir()
+    poseFile = os.path.join(tmpDir, 'rank1_confidence0.50.sdf')
+    with open(poseFile, 'w') as f:
+      f.write('x' * 10)
+
+    cache = PoseCache(os.path.join(tmpDir, 'cache'), maxSize=15)
+    oldKey, newKey = getCacheKey(smiles='CCO'), getCacheKey(smiles='CCN')
+    cache.put(oldKey, [poseFile])
+    time.sleep(0.01)
+    cache.put(newKey, [poseFile])
+    cache.evict()
+    self.assertIsNone(cache.get(oldKey))
+    self.assertEqual(len(cache.get(newKey)), 1)
+
+  def testMetrics(self):
+    tmpDir = self.getTmpDir()
+    metricsFile, logFile = os.path.join(tmpDir, 'metrics.jsonl'), os.path.join(tmpDir, 'inference.log')
+    with measureResources(metricsFile, 'predictStep', [0]):
+      sum(range(10 ** 5))
+    with open(logFile, 'w') as f:
+      f.write('DIFFDOCK_TIMING ligA 2.5\nsome progress\nDIFFDOCK_TIMING ligB 1.5\nDIFFDOCK_PEAK_RSS 2048\n')
+
+    complexTimes, peakRSS = parseInferenceLog(logFile)
+    self.assertEqual(complexTimes, {'ligA': 2.5, 'ligB': 1.5})
+    self.assertEqual(peakRSS, 2)
+    appendMetrics(metricsFile, {'step': 'inference', 'args': [0], 'complexTimes': complexTimes})
+
+    metrics = summarizeMetrics(readMetrics(metricsFile))
+    self.assertEqual(metrics['steps']['predictStep']['count'], 1)
+    self.assertEqual(metrics['complexes']['count'], 2)
+    self.assertAlmostEqual(metrics['complexes']['mean'], 2)
+
+  def testBenchmarkPipeline(self):
+    results = runBenchmark(20, self.getTmpDir(), nSamples=3, nShards=2, keepTopK=2, pack=True)
+    for stageName in ['buildCSV', 'stubInference', 'parseOutputs', 'filterPoses', 'packPoses', 'createSet']:
+      self.assertIn(stageName, results)
+    # The top 2 poses of each of the 20 ligands are kept in the manifest and registered in the output set
+    self.assertEqual(results['filterPoses']['nPoses'], 40)
+    self.assertEqual(results['createSet']['nPoses'], 40)
+
+  def testLocalJobArray(self):
+    jobArray = LocalJobArray(os.path.join(self.getTmpDir(), 'jobs'), nWorkers=2)
+    for taskIdx, command in enumerate(['echo done > out_0.txt', 'exit 3', 'true']):
+      jobArray.writeTask(taskIdx, command, cwd=jobArray.jobsDir)
+    jobArray.submit([0, 1])
+    self.assertEqual(jobArray.wait(), {0: 0, 1: 3})
+    self.assertTrue(os.path.exists(os.path.join(jobArray.jobsDir, 'out_0.txt')))
+
+  def testClusterPoses(self):
+    # Acetate-like molecule whose two oxygens are equivalent: swapping them gives the same pose
+    elements, bonds = ['C', 'C', 'O', 'O'], [(1, 2), (2, 3), (2, 4)]
+    posesCoords = [[(0, 0, 0), (1.5, 0, 0), (2, -1, 0), (2, 1, 0)], [(0, 0, 0), (1.5, 0, 0), (2, 1, 0), (2, -1, 0)],
+                   [(5, 0, 0), (6.5, 0, 0), (7, 1, 0), (7, -1, 0)]]
+    tmpDir, poses = self.getTmpDir(), []
+    for rank, coords in enumerate(posesCoords, start=1):
+      lines = ['lig', '', '', f'{len(elements):>3}{len(bonds):>3}  0  0  0  0  0  0  0  0999 V2000']
+      lines += [f'{x:>10.4f}{y:>10.4f}{z:>10.4f} {element:<3} 0  0' for (x, y, z), element in zip(coords, elements)]
+      lines += [f'{i:>3}{j:>3}  1  0' for i, j in bonds] + ['M  END', '$$$$']
+      poses.append((rank, 1.0 - rank, os.path.join(tmpDir, f'rank{rank}_confidence{1.0 - rank:.2f}.sdf')))
+      with open(poses[-1][2], 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+    kept, dropped = clusterPoses(poses, rmsdThreshold=1.0)
+    self.assertEqual(kept, [poses[0], poses[2]])
+    self.assertEqual(dropped, [poses[1]])
+
+  def testSmilesLibrary(self):
+    tmpDir = self.getTmpDir()
+    smiFile, csvFile = os.path.join(tmpDir, 'library.smi'), os.path.join(tmpDir, 'library.csv.gz')
+    with open(smiFile, 'w') as f:
+      f.write('SMILES Name\nCCO ethanol\n# comment\nc1ccccc1\nCCN ethanol\nCC(=O)O acetic acid\n')
+    with gzip.open(csvFile, 'wt') as f:
+      f.write('id,Smiles,mw\nZ1,CCO,46.1\nZ2,CCN,45.1\n')
+
+    self.assertEqual(list(iterSmilesLibrary(smiFile)), [('ethanol', 'CCO'), ('mol3', 'c1ccccc1'),
+                                                        ('ethanol_4', 'CCN'), ('acetic_acid', 'CC(=O)O')])
+    self.assertEqual(list(iterSmilesLibrary(csvFile)), [('Z1', 'CCO'), ('Z2', 'CCN')])
@@ -1 +1,6 @@
-from .utils import *
\ No newline at end of file
+from .utils import *
+from .cache import *
+from .metrics import *
+from .jobs import *
+from .clustering import *
+from .summary import *
@@ -0,0 +1,124 @@
+# **************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os, shutil, json, hashlib, sqlite3, time
+
+
+def getFileHash(fileName, blockSize=2**20):
+  '''Returns the sha256 hex digest of the content of a file'''
+  hasher = hashlib.sha256()
+  with open(fileName, 'rb') as f:
+    for block in iter(lambda: f.read(blockSize), b''):
+      hasher.update(block)
+  return hasher.hexdigest()
+
+def getCacheKey(**keyFields):
+  '''Returns a content address for the given fields, which must be json serializable'''
+  return hashlib.sha256(json.dumps(keyFields, sort_keys=True).encode()).hexdigest()
+
+
+class PoseCache:
+  '''On-disk cache of DiffDock poses. Each entry is a directory with the ranked sdf files of a complex, addressed by
+  the hash of everything that determines the docking result. A sqlite index keeps the entry sizes and last access
+  times so the least recently used entries can be evicted when the cache exceeds its size limit'''
+  def __init__(self, cacheDir, maxSize=None):
+    self.cacheDir = os.path.abspath(cacheDir)
+    self.maxSize = maxSize
+    os.makedirs(self.cacheDir, exist_ok=True)
+    with self._connect() as con:
+      con.execute('CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, size INTEGER, accessed REAL)')
+
+  def _connect(self):
+    return sqlite3.connect(os.path.join(self.cacheDir, 'index.sqlite'), timeout=60)
+
+  def getEntryDir(self, key):
+    return os.path.join(self.cacheDir, key[:2], key)
+
+  def get(self, key):
+    '''Returns the list of cached pose files for the key, or None if it is not in the cache'''
+    eDir = self.getEntryDir(key)
+    with self._connect() as con:
+      found = con.execute('SELECT 1 FROM entries WHERE key=?', (key,)).fetchone()
+      if not found or not os.path.isdir(eDir):
+        return None
+      con.execute('UPDATE entries SET accessed=? WHERE key=?', (time.time(), key))
+    return [os.path.join(eDir, f) for f in sorted(os.listdir(eDir))]
+
+  def put(self, key, files):
+    '''Stores a copy of the files in the cache entry of the key, replacing any previous content'''
+    eDir = self.getEntryDir(key)
+    tmpDir = f'{eDir}.{os.getpid()}.tmp'
+    os.makedirs(tmpDir, exist_ok=True)
+    size = 0
+    for file in files:
+      shutil.copy(file, tmpDir)
+      size += os.path.getsize(file)
+
+    if os.path.exists(eDir):
+      shutil.rmtree(eDir)
+    os.rename(tmpDir, eDir)
+    with self._connect() as con:
+      con.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?)', (key, size, time.time()))
+
+  def evict(self):
+    '''Removes the least recently used entries until the cache size is under its limit'''
+    if not self.maxSize:
+      return
+    with self._connect() as con:
+      total = con.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+      for key, size in con.execute('SELECT key, size FROM entries ORDER BY accessed').fetchall():
+        if total <= self.maxSize:
+          break
+        shutil.rmtree(self.getEntryDir(key), ignore_errors=True)
+        con.execute('DELETE FROM entries WHERE key=?', (key,))
+        total -= size
+
+
+class SmilesCache:
+  '''Persistent table of the canonical SMILES of molecule files, addressed by the hash of their content'''
+  def __init__(self, cacheFile):
+    os.makedirs(os.path.dirname(os.path.abspath(cacheFile)), exist_ok=True)
+    self.cacheFile = cacheFile
+    with self._connect() as con:
+      con.execute('CREATE TABLE IF NOT EXISTS smiles (hash TEXT PRIMARY KEY, smiles TEXT)')
+
+  def _connect(self):
+    return sqlite3.connect(self.cacheFile, timeout=60)
+
+  def getMany(self, hashes, chunkSize=500):
+    '''Returns the {hash: smiles} of the given hashes found in the cache'''
+    hashes, found = list(hashes), {}
+    with self._connect() as con:
+      for i in range(0, len(hashes), chunkSize):
+        chunk = hashes[i:i + chunkSize]
+        query = f'SELECT hash, smiles FROM smiles WHERE hash IN ({",".join("?" * len(chunk))})'
+        found.update(con.execute(query, chunk).fetchall())
+    return found
+
+  def putMany(self, smilesDic):
+    '''Stores the {hash: smiles} in the cache'''
+    with self._connect() as con:
+      con.executemany('INSERT OR REPLACE INTO smiles VALUES (?, ?)', smilesDic.items())
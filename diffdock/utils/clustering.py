@@ -0,0 +1,124 @@
+# **************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+from .utils import readPoseRecord
+
+
+def parseSDFRecord(sdfText, removeHs=True):
+  '''Parses the atoms of a V2000 sdf record. Returns its elements, coordinates (n x 3 array) and bonds (pairs of atom
+  indexes), without the hydrogens if removeHs'''
+  lines = sdfText.splitlines()
+  if len(lines) < 4 or 'V3000' in lines[3]:
+    raise ValueError('Only V2000 sdf records can be parsed')
+  nAtoms, nBonds = int(lines[3][0:3]), int(lines[3][3:6])
+  elements, coords = [], []
+  for line in lines[4:4 + nAtoms]:
+    coords.append((float(line[0:10]), float(line[10:20]), float(line[20:30])))
+    elements.append(line[31:34].strip())
+  bonds = [(int(line[0:3]) - 1, int(line[3:6]) - 1) for line in lines[4 + nAtoms:4 + nAtoms + nBonds]]
+
+  keep = [i for i, element in enumerate(elements) if not (removeHs and element == 'H')]
+  newIdxs = {oldIdx: newIdx for newIdx, oldIdx in enumerate(keep)}
+  bonds = [(newIdxs[i], newIdxs[j]) for i, j in bonds if i in newIdxs and j in newIdxs]
+  return [elements[i] for i in keep], np.array([coords[i] for i in keep]).reshape(-1, 3), bonds
+
+def getSymmetryClasses(elements, bonds):
+  '''Groups the atoms of a molecule in classes of topologically equivalent atoms by iteratively refining their
+  element with the classes of their neighbours. Returns the list of atom index arrays of each class'''
+  neighbours = [[] for _ in elements]
+  for i, j in bonds:
+    neighbours[i].append(j)
+    neighbours[j].append(i)
+
+  labels = [sorted(set(elements)).index(element) for element in elements]
+  for _ in range(len(elements)):
+    signatures = [(labels[i], tuple(sorted(labels[j] for j in neighbours[i]))) for i in range(len(elements))]
+    sortedSignatures = sorted(set(signatures))
+    newLabels = [sortedSignatures.index(signature) for signature in signatures]
+    if len(sortedSignatures) == len(set(labels)):
+      break
+    labels = newLabels
+
+  return [np.flatnonzero(np.array(labels) == label) for label in sorted(set(labels))]
+
+def pairwiseRMSD(coords, symClasses):
+  '''Returns the matrix of RMSD between the poses of a molecule (coords: nPoses x nAtoms x 3 array) without
+  superposition. The atoms of each symmetry class are matched between each pair of poses by the assignment with the
+  lowest squared distance, so symmetric poses are not counted as different'''
+  from scipy.optimize import linear_sum_assignment
+  singles = np.concatenate([symClass for symClass in symClasses if len(symClass) == 1] + [np.array([], dtype=int)])
+  sqDists = ((coords[:, None, singles] - coords[None, :, singles]) ** 2).sum(axis=(2, 3))
+  for symClass in [symClass for symClass in symClasses if len(symClass) > 1]:
+    classCoords = coords[:, symClass]
+    # Squared distances between the atoms of the class in each pair of poses: nPoses x nPoses x k x k
+    atomDists = ((classCoords[:, None, :, None] - classCoords[None, :, None, :]) ** 2).sum(axis=-1)
+    for i in range(len(coords)):
+      for j in range(i + 1, len(coords)):
+        rows, cols = linear_sum_assignment(atomDists[i, j])
+        minDist = atomDists[i, j][rows, cols].sum()
+        sqDists[i, j] += minDist
+        sqDists[j, i] += minDist
+  return np.sqrt(sqDists / coords.shape[1])
+
+def clusterPoses(poses, rmsdThreshold):
+  '''Clusters the (rank, confidence, poseReference) poses of a molecule, sorted by rank, so each pose joins the
+  cluster of the first better ranked representative closer than rmsdThreshold, or becomes a new representative.
+  Returns (representatives, dropped). The poses are kept if their records cannot be compared'''
+  if len(poses) < 2:
+    return list(poses), []
+  try:
+    molecules = [parseSDFRecord(readPoseRecord(poseRef)) for _, _, poseRef in poses]
+  except (ValueError, IndexError, OSError):
+    return list(poses), []
+  elements, _, bonds = molecules[0]
+  if not elements or any(molElements != elements for molElements, _, _ in molecules):
+    return list(poses), []
+
+  order = sorted(range(len(poses)), key=lambda i: -poses[i][1])
+  rmsds = pairwiseRMSD(np.array([molecules[i][1] for i in order]), getSymmetryClasses(elements, bonds))
+  repIdxs = []
+  for i in range(len(order)):
+    if all(rmsds[i, repIdx] >= rmsdThreshold for repIdx in repIdxs):
+      repIdxs.append(i)
+  keep = {order[i] for i in repIdxs}
+  return [pose for i, pose in enumerate(poses) if i in keep], [pose for i, pose in enumerate(poses) if i not in keep]
+
+def _clusterComplexPoses(args):
+  return clusterPoses(*args)
+
+def clusterPoseIndex(poseIndex, rmsdThreshold, nProcs=1):
+  '''Clusters the poses of each complex of a poses index in a pool of nProcs processes.
+  Returns {complexName: (representatives, dropped)}'''
+  cNames = list(poseIndex)
+  tasks = [(poseIndex[cName], rmsdThreshold) for cName in cNames]
+  if nProcs > 1 and len(tasks) > 1:
+    with ProcessPoolExecutor(min(nProcs, len(tasks))) as executor:
+      results = executor.map(_clusterComplexPoses, tasks, chunksize=max(1, len(tasks) // (4 * nProcs)))
+      return dict(zip(cNames, results))
+  return {cName: clusterPoses(*task) for cName, task in zip(cNames, tasks)}
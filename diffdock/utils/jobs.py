@@ -0,0 +1,172 @@
+# **************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import abc, os, re, subprocess, time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class JobArray(abc.ABC):
+  '''Set of independent shell tasks run by an execution backend. Each task writes its exit code in a done file when it
+  finishes, so the completion of the tasks can be checked from any process, even after a restart'''
+  pollTime = 30
+
+  def __init__(self, jobsDir):
+    self.jobsDir = os.path.abspath(jobsDir)
+    os.makedirs(self.jobsDir, exist_ok=True)
+
+  def getTaskScript(self, taskIdx):
+    return os.path.join(self.jobsDir, f'task_{taskIdx}.sh')
+
+  def getDoneFile(self, taskIdx):
+    return os.path.join(self.jobsDir, f'task_{taskIdx}.done')
+
+  def getJobIdsFile(self):
+    return os.path.join(self.jobsDir, 'jobIds.txt')
+
+  def getTasksFile(self):
+    return os.path.join(self.jobsDir, 'tasks.txt')
+
+  def readList(self, listFile):
+    if not os.path.exists(listFile):
+      return []
+    with open(listFile) as f:
+      return f.read().split()
+
+  def writeTask(self, taskIdx, command, cwd=None):
+    '''Writes the script of a task, removing any done file of a previous execution'''
+    if os.path.exists(self.getDoneFile(taskIdx)):
+      os.remove(self.getDoneFile(taskIdx))
+    with open(self.getTaskScript(taskIdx), 'w') as f:
+      f.write('#!/bin/bash\n(\n')
+      if cwd:
+        f.write(f'cd {cwd}\n')
+      f.write(f'{command}\n)\n')
+      f.write(f'echo $? > {self.getDoneFile(taskIdx)}.tmp && mv {self.getDoneFile(taskIdx)}.tmp '
+              f'{self.getDoneFile(taskIdx)}\n')
+
+  def submit(self, taskIdxs):
+    '''Submits the tasks, storing their indexes and the ids of their jobs'''
+    taskIdxs = list(taskIdxs)
+    jobIds = self._submit(taskIdxs) if taskIdxs else []
+    for listFile, items in [(self.getTasksFile(), taskIdxs), (self.getJobIdsFile(), jobIds)]:
+      with open(listFile, 'w') as f:
+        f.write(''.join(f'{item}\n' for item in items))
+    return jobIds
+
+  def getExitCode(self, taskIdx):
+    '''Returns the exit code of a finished task, or None if it has not finished'''
+    if os.path.exists(self.getDoneFile(taskIdx)):
+      with open(self.getDoneFile(taskIdx)) as f:
+        return int(f.read().strip() or 1)
+
+  def wait(self):
+    '''Waits until all the submitted tasks are finished or their jobs are not alive anymore.
+    Returns their exit codes {taskIdx: exitCode}, None for the tasks that finished without writing it (e.g: killed)'''
+    taskIdxs = [int(taskIdx) for taskIdx in self.readList(self.getTasksFile())]
+    jobIds = self.readList(self.getJobIdsFile())
+    while True:
+      exitCodes = {taskIdx: self.getExitCode(taskIdx) for taskIdx in taskIdxs}
+      if all(code is not None for code in exitCodes.values()) or not any(self.isAlive(jobId) for jobId in jobIds):
+        # Tasks finishing right before the last check
+        return {taskIdx: self.getExitCode(taskIdx) for taskIdx in taskIdxs}
+      time.sleep(self.pollTime)
+
+  @abc.abstractmethod
+  def _submit(self, taskIdxs):
+    '''Launches the scripts of the tasks in the backend. Returns the ids of their jobs'''
+
+  @abc.abstractmethod
+  def isAlive(self, jobId):
+    '''Returns whether a job is still queued or running in the backend'''
+
+
+class LocalJobArray(JobArray):
+  '''Runs the tasks in a pool of local processes. It mimics a queue system to run job arrays without one'''
+  _executors, _futures = {}, {}
+  pollTime = 1
+
+  def __init__(self, jobsDir, nWorkers=1):
+    super().__init__(jobsDir)
+    self.nWorkers = max(1, nWorkers)
+
+  def _submit(self, taskIdxs):
+    executor = self._executors.setdefault(self.jobsDir, ThreadPoolExecutor(self.nWorkers))
+    jobIds = []
+    for taskIdx in taskIdxs:
+      jobId = f'{self.jobsDir}:{taskIdx}'
+      self._futures[jobId] = executor.submit(subprocess.call, ['bash', self.getTaskScript(taskIdx)])
+      jobIds.append(jobId)
+    return jobIds
+
+  def isAlive(self, jobId):
+    return jobId in self._futures and not self._futures[jobId].done()
+
+
+class QueueJobArray(JobArray):
+  '''Submits the tasks to the queue system of a Scipion host configuration. With SLURM, all the tasks are submitted
+  as a single job array; with any other queue system, one job is submitted per task'''
+  def __init__(self, jobsDir, hostConfig, submitDict):
+    super().__init__(jobsDir)
+    self.hostConfig, self.submitDict = hostConfig, submitDict
+
+  def isSlurm(self):
+    return self.hostConfig.getSubmitCommand().split()[0] == 'sbatch'
+
+  def _submit(self, taskIdxs):
+    if self.isSlurm():
+      taskCommand = f'bash {os.path.join(self.jobsDir, "task_${SLURM_ARRAY_TASK_ID}.sh")}'
+      arrayOption = '--array=' + ','.join(str(taskIdx) for taskIdx in taskIdxs)
+      return [self.submitJob('array', taskCommand, arrayOption)]
+    return [self.submitJob(taskIdx, f'bash {self.getTaskScript(taskIdx)}') for taskIdx in taskIdxs]
+
+  def submitJob(self, jobName, command, submitOptions=''):
+    '''Submits a job running command with the host submit template. Returns the job id'''
+    submitDict = dict(self.submitDict)
+    submitDict.update({'JOB_NAME': f'{submitDict.get("JOB_NAME", "diffdock")}_{jobName}', 'JOB_NODES': 1,
+                       'JOB_COMMAND': command, 'JOB_SCRIPT': os.path.join(self.jobsDir, f'job_{jobName}.job'),
+                       'JOB_LOGS': os.path.join(self.jobsDir, f'job_{jobName}')})
+    with open(submitDict['JOB_SCRIPT'], 'w') as f:
+      f.write(self.hostConfig.getSubmitTemplate() % submitDict + '\n\n')
+
+    submitCommand = self.hostConfig.getSubmitCommand() % submitDict
+    if submitOptions:
+      program, _, rest = submitCommand.partition(' ')
+      submitCommand = f'{program} {submitOptions} {rest}'
+    result = subprocess.run(submitCommand, shell=True, capture_output=True, text=True)
+    jobId = re.search(r'(\d+)', result.stdout)
+    if result.returncode != 0 or not jobId:
+      raise Exception(f'Could not submit the job {submitCommand}:\n{result.stdout}{result.stderr}')
+    return jobId.group(1)
+
+  def isAlive(self, jobId):
+    '''Returns whether a job is still in the queue, following the Scipion criteria on the output of the host
+    check command'''
+    result = subprocess.run(self.hostConfig.getCheckCommand() % {'JOB_ID': jobId}, shell=True,
+                            capture_output=True, text=True)
+    jobDoneRegex = self.hostConfig.getJobDoneRegex()
+    if not result.stdout:
+      return False
+    return not re.search(jobDoneRegex, result.stdout) if jobDoneRegex else True
@@ -0,0 +1,107 @@
+# **************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import contextlib, json, os, resource, statistics, threading, time
+
+# Tags of the lines written by the inference wrapper to the inference log. Keep in sync with diffdock_inference.py
+TIMING_TAG, PEAK_RSS_TAG = 'DIFFDOCK_TIMING', 'DIFFDOCK_PEAK_RSS'
+# Per thread usage where available, so the steps running in parallel threads do not count each other's CPU time
+RUSAGE_STEP = getattr(resource, 'RUSAGE_THREAD', resource.RUSAGE_SELF)
+
+_metricsLock = threading.Lock()
+
+def appendMetrics(metricsFile, record):
+  '''Appends a json record as a line of a metrics file'''
+  with _metricsLock:
+    with open(metricsFile, 'a') as f:
+      f.write(json.dumps(record) + '\n')
+
+def readMetrics(metricsFile):
+  '''Returns the list of records of a metrics file'''
+  if not os.path.exists(metricsFile):
+    return []
+  with open(metricsFile) as f:
+    return [json.loads(line) for line in f if line.strip()]
+
+@contextlib.contextmanager
+def measureResources(metricsFile, stepName, stepArgs=()):
+  '''Records in the metrics file the wall time, CPU time (of the running thread and of the finished subprocesses)
+  and peak resident memory (MB) of the code run in the context.
+  Subprocesses are accounted when they finish, and their peak memory is the highest of any of them so far'''
+  startWall = time.time()
+  startSelf, startChildren = resource.getrusage(RUSAGE_STEP), resource.getrusage(resource.RUSAGE_CHILDREN)
+  try:
+    yield
+  finally:
+    endSelf, endChildren = resource.getrusage(RUSAGE_STEP), resource.getrusage(resource.RUSAGE_CHILDREN)
+    appendMetrics(metricsFile, {
+      'step': stepName, 'args': list(stepArgs),
+      'start': round(startWall, 3), 'wallTime': round(time.time() - startWall, 3),
+      'cpuTime': round(endSelf.ru_utime + endSelf.ru_stime - startSelf.ru_utime - startSelf.ru_stime, 3),
+      'childrenCpuTime': round(endChildren.ru_utime + endChildren.ru_stime -
+                               startChildren.ru_utime - startChildren.ru_stime, 3),
+      'peakRSS': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+      'childrenPeakRSS': round(endChildren.ru_maxrss / 1024, 1)})
+
+def parseInferenceLog(logFile):
+  '''Returns the sampling time of each complex {complexName: seconds} and the peak resident memory (MB) of the
+  inference process found in an inference log written by the DiffDock wrapper'''
+  timings, peakRSS = {}, None
+  if os.path.exists(logFile):
+    with open(logFile, errors='ignore') as f:
+      for line in f:
+        if line.startswith(TIMING_TAG):
+          _, cName, seconds = line.split()
+          timings[cName] = float(seconds)
+        elif line.startswith(PEAK_RSS_TAG):
+          peakRSS = max(peakRSS or 0, float(line.split()[1]) / 1024)
+  return timings, peakRSS
+
+def summarizeMetrics(stepRecords):
+  '''Aggregates the records of a metrics file by step, together with the statistics of the complex timings found
+  in them. Returns a json serializable dictionary'''
+  steps, complexTimings = {}, {}
+  for record in stepRecords:
+    stepSummary = steps.setdefault(record['step'], {'count': 0, 'wallTime': 0.0, 'cpuTime': 0.0, 'peakRSS': 0.0})
+    stepSummary['count'] += 1
+    stepSummary['wallTime'] += record.get('wallTime', 0.0)
+    stepSummary['cpuTime'] += record.get('cpuTime', 0.0) + record.get('childrenCpuTime', 0.0)
+    stepSummary['peakRSS'] = max(stepSummary['peakRSS'], record.get('peakRSS') or 0.0,
+                                 record.get('childrenPeakRSS') or 0.0)
+    complexTimings.update(record.get('complexTimes', {}))
+
+  summary = {'steps': steps}
+  if complexTimings:
+    times = list(complexTimings.values())
+    summary['complexes'] = {'count': len(times), 'total': sum(times), 'mean': statistics.mean(times),
+                            'median': statistics.median(times), 'max': max(times)}
+    # The prediction steps run in parallel, so the throughput uses the span from the first to the last of them
+    predictRecords = [record for record in stepRecords if record['step'] == 'predictStep']
+    if predictRecords:
+      predictSpan = max(r['start'] + r['wallTime'] for r in predictRecords) - min(r['start'] for r in predictRecords)
+      if predictSpan > 0:
+        summary['complexes']['throughput'] = len(times) / predictSpan
+  return summary
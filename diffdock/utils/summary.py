@@ -0,0 +1,116 @@
+# **************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import math, os, sqlite3
+
+from .utils import parseManifestLine
+
+# Width of the confidence histogram bins stored in the summary
+HISTOGRAM_BIN_WIDTH = 0.25
+SUMMARY_ORDERS = {'bestConfidence': 'bestConfidence DESC', 'meanConfidence': 'meanConfidence DESC',
+                  'nPoses': 'nPoses DESC', 'complex': 'complex'}
+
+
+class PoseSummary:
+  '''Compact sqlite table with a row per docked complex (number of poses, best and mean confidence, confidence
+  spread and offset of its poses in the output manifest), together with the confidence histograms of the complexes
+  and of all the poses. It lets the results be browsed and plotted without reading the pose files'''
+  def __init__(self, summaryFile):
+    self.summaryFile = summaryFile
+
+  def _connect(self):
+    return sqlite3.connect(self.summaryFile, timeout=60)
+
+  def build(self, manifestFile, binWidth=HISTOGRAM_BIN_WIDTH, chunkSize=10000):
+    '''Builds the summary reading the manifest line by line, replacing any previous summary'''
+    tmpFile = f'{self.summaryFile}.{os.getpid()}.tmp'
+    if os.path.exists(tmpFile):
+      os.remove(tmpFile)
+    histograms = {'best': {}, 'all': {}}
+
+    def summarize(cName, offset, confs):
+      mean = sum(confs) / len(confs)
+      std = math.sqrt(sum((conf - mean) ** 2 for conf in confs) / len(confs))
+      for kind, values in [('best', [max(confs)]), ('all', confs)]:
+        for conf in values:
+          binIdx = math.floor(conf / binWidth)
+          histograms[kind][binIdx] = histograms[kind].get(binIdx, 0) + 1
+      return cName, len(confs), max(confs), mean, std, max(confs) - min(confs), offset
+
+    with sqlite3.connect(tmpFile) as con, open(manifestFile, 'rb') as f:
+      con.execute('CREATE TABLE complexes (complex TEXT PRIMARY KEY, nPoses INTEGER, bestConfidence REAL, '
+                  'meanConfidence REAL, confidenceStd REAL, confidenceRange REAL, manifestOffset INTEGER)')
+      con.execute('CREATE TABLE histograms (kind TEXT, lower REAL, upper REAL, count INTEGER)')
+      f.readline()
+      offset, rows, current = f.tell(), [], None
+      for line in iter(f.readline, b''):
+        cName, (_, conf, _) = parseManifestLine(line.decode())
+        if current is None or cName != current[0]:
+          if current is not None:
+            rows.append(summarize(*current))
+          current = (cName, offset, [])
+        current[2].append(conf)
+        offset += len(line)
+        if len(rows) >= chunkSize:
+          con.executemany('INSERT OR REPLACE INTO complexes VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+          rows = []
+      if current is not None:
+        rows.append(summarize(*current))
+      con.executemany('INSERT OR REPLACE INTO complexes VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+
+      for kind, counts in histograms.items():
+        con.executemany('INSERT INTO histograms VALUES (?, ?, ?, ?)',
+                        [(kind, binIdx * binWidth, (binIdx + 1) * binWidth, count)
+                         for binIdx, count in sorted(counts.items())])
+      for column in ['bestConfidence', 'meanConfidence', 'nPoses']:
+        con.execute(f'CREATE INDEX {column}Index ON complexes ({column})')
+    os.replace(tmpFile, self.summaryFile)
+
+  def count(self):
+    with self._connect() as con:
+      return con.execute('SELECT COUNT(*) FROM complexes').fetchone()[0]
+
+  def getPage(self, page, pageSize, orderBy='bestConfidence'):
+    '''Returns the rows (as dictionaries) of a page (starting at 1) of the complexes sorted by orderBy'''
+    with self._connect() as con:
+      con.row_factory = sqlite3.Row
+      rows = con.execute(f'SELECT * FROM complexes ORDER BY {SUMMARY_ORDERS[orderBy]} LIMIT ? OFFSET ?',
+                         (pageSize, (page - 1) * pageSize)).fetchall()
+    return [dict(row) for row in rows]
+
+  def getComplex(self, cName):
+    '''Returns the row of a complex as a dictionary, or None if it is not in the summary'''
+    with self._connect() as con:
+      con.row_factory = sqlite3.Row
+      row = con.execute('SELECT * FROM complexes WHERE complex=?', (cName,)).fetchone()
+    return dict(row) if row else None
+
+  def getHistogram(self, kind='best'):
+    '''Returns the (lower, upper, count) bins of the confidence histogram of the best pose of each complex (best)
+    or of all the poses (all)'''
+    with self._connect() as con:
+      return con.execute('SELECT lower, upper, count FROM histograms WHERE kind=? ORDER BY lower',
+                         (kind,)).fetchall()
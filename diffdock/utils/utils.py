@@ -22,4 +22,331 @@
 # *  All comments concerning this program package may be sent to the
 # *  e-mail address 'scipion@cnb.csic.es'
 # *
-# **************************************************************************
\ No newline at end of file
+# **************************************************************************
+import bz2, csv, gzip, lzma, os, re, shutil, subprocess
+
+
+POSE_FILE_REGEX = re.compile(r'^rank(\d+)_confidence(.+)\.sdf$')
+MANIFEST_HEADER = 'complex\trank\tconfidence\tpath\n'
+PACKED_SEP = '@'
+# Poses appended to an output set between commits
+OUTPUT_COMMIT_SIZE = 10000
+
+# Heavy atoms in SMILES: bracket atoms other than hydrogens, and atoms of the organic subset
+SMILES_ATOM_REGEX = re.compile(r'\[(?!\d*H[\]+\-@\d:])[^\]]+\]|Cl|Br|[BCNOPSFIbcnops]')
+# Estimated inference memory per sample in a batch (MB): fixed part plus a part per ligand heavy atom
+SAMPLE_BASE_MEM, SAMPLE_ATOM_MEM = 150, 8
+OOM_MESSAGES = ['out of memory', 'OutOfMemoryError', 'MemoryError', 'Killed']
+# Exit codes of a process killed with SIGKILL (by the kernel OOM killer), as reported by the shell and by subprocess
+OOM_EXIT_CODES = {137, -9}
+EXIT_CODE_TAG = 'DIFFDOCK_EXIT_CODE'
+THREAD_ENV_VARS = ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'NUMEXPR_NUM_THREADS']
+COMPRESSED_OPENERS = {'.gz': gzip.open, '.bz2': bz2.open, '.xz': lzma.open}
+WATER_RESIDUES = {'HOH', 'WAT', 'DOD', 'H2O'}
+LIBRARY_TITLE_COLUMNS = ['name', 'title', 'id', 'compound_id', 'molecule_name', 'zinc_id', 'idnumber']
+
+def openLibraryFile(libraryFile):
+  """Opens a text library file for reading, decompressing it if it ends with .gz, .bz2 or .xz"""
+  opener = COMPRESSED_OPENERS.get(os.path.splitext(libraryFile)[1].lower(), open)
+  return opener(libraryFile, 'rt')
+
+def iterSmilesLibrary(libraryFile):
+  """Yields the (title, smiles) of the molecules of a SMILES library, reading it line by line. The library can be a
+  SMILES file (smiles and optional title per line) or a csv file with a smiles column and an optional name column,
+  optionally compressed. The titles are made valid and unique file names, and the molecules without title are named
+  by their position"""
+  baseName = re.sub(r'\.(gz|bz2|xz)$', '', libraryFile.lower())
+  usedTitles = set()
+  with openLibraryFile(libraryFile) as f:
+    if baseName.endswith('.csv'):
+      reader = csv.DictReader(f)
+      columns = {column.lower(): column for column in reader.fieldnames or []}
+      smiColumn = next((columns[col] for col in columns if 'smiles' in col), None)
+      if smiColumn is None:
+        raise ValueError(f'No SMILES column found in {libraryFile}')
+      titleColumn = next((columns[col] for col in LIBRARY_TITLE_COLUMNS if col in columns), None)
+      entries = ((row[smiColumn], row[titleColumn] if titleColumn else '') for row in reader)
+    else:
+      # The title is the whole rest of the line, as it can contain spaces
+      entries = ((line.split(maxsplit=1) + [''])[:2] for line in f if line.strip() and not line.startswith('#'))
+
+    for i, (smi, title) in enumerate(entries):
+      smi = smi.strip()
+      if not smi or (i == 0 and smi.lower() == 'smiles'):
+        continue
+      title = re.sub(r'[^\w.-]', '_', title.strip()) or f'mol{i + 1}'
+      if title in usedTitles:
+        title = f'{title}_{i + 1}'
+      usedTitles.add(title)
+      yield title, smi
+
+def getComplexName(title, recId=None):
+  """Returns the DiffDock complex name of a ligand docked on a receptor of an ensemble (or a single receptor if None)"""
+  return title if recId is None else f'{title}_rec{recId}'
+
+def splitInShards(items, nShards):
+  """Splits a list of items in nShards contiguous and balanced sublists. If there are less items than shards,
+  the last sublists will be empty"""
+  items, nShards = list(items), max(1, nShards)
+  size, rest = divmod(len(items), nShards)
+  shards, start = [], 0
+  for i in range(nShards):
+    end = start + size + (1 if i < rest else 0)
+    shards.append(items[start:end])
+    start = end
+  return shards
+
+def writeInputCSV(csvFile, complexes):
+  """Writes the DiffDock input csv file for the (complexName, receptorFile, smiles) complexes"""
+  with open(csvFile, 'w') as f:
+    f.write('complex_name,protein_path,ligand_description,protein_sequence\n')
+    f.writelines(f'{cName},{recFile},{smi},\n' for cName, recFile, smi in complexes)
+
+def moveComplexDir(complexDir, outDir):
+  """Moves a complex output directory into outDir, replacing any previous one with the same name.
+  Returns the new path of the directory"""
+  target = os.path.join(outDir, os.path.basename(complexDir))
+  if os.path.exists(target):
+    shutil.rmtree(target)
+  shutil.move(complexDir, target)
+  return target
+
+def mergeShardOutputs(shardDir, outDir, overwrite=True):
+  """Moves the complex output directories generated in a shard directory into the final output directory.
+  If not overwrite, the complexes that already have poses in the output directory are kept"""
+  for entry in os.scandir(shardDir):
+    outComplexDir = os.path.join(outDir, entry.name)
+    if entry.is_dir() and (overwrite or not (os.path.isdir(outComplexDir) and indexComplexDir(outComplexDir))):
+      moveComplexDir(entry.path, outDir)
+  shutil.rmtree(shardDir)
+
+def linkOrCopy(inFile, outFile):
+  """Hard links a file, copying it if the link is not possible (e.g: different filesystems)"""
+  if os.path.exists(outFile):
+    os.remove(outFile)
+  try:
+    os.link(inFile, outFile)
+  except OSError:
+    shutil.copy(inFile, outFile)
+
+def indexComplexDir(complexDir):
+  """Returns the list of (rank, confidence, path) of the poses in a DiffDock complex directory, sorted by rank"""
+  poses = []
+  with os.scandir(complexDir) as entries:
+    for entry in entries:
+      match = POSE_FILE_REGEX.match(entry.name)
+      if match:
+        poses.append((int(match.group(1)), float(match.group(2)), os.path.join(complexDir, entry.name)))
+  return sorted(poses)
+
+def indexOutputDocks(oDir, skipNames=()):
+  """Indexes in a single pass the DiffDock complex directories in oDir.
+  Returns a dictionary {complexName: [(rank, confidence, path), ...]}"""
+  index = {}
+  with os.scandir(oDir) as entries:
+    for entry in entries:
+      if entry.is_dir() and entry.name not in skipNames:
+        index[entry.name] = indexComplexDir(entry.path)
+  return index
+
+def writeManifest(manifestFile, index, append=False):
+  """Writes the poses index as a tab separated manifest file"""
+  writeHeader = not append or not os.path.exists(manifestFile)
+  with open(manifestFile, 'a' if append else 'w') as f:
+    if writeHeader:
+      f.write(MANIFEST_HEADER)
+    for cName, poses in index.items():
+      f.writelines(f'{cName}\t{rank}\t{conf}\t{path}\n' for rank, conf, path in poses)
+
+def parseManifestLine(line):
+  """Parses a manifest line into the complex name and its (rank, confidence, path) pose"""
+  cName, rank, conf, path = line.rstrip('\n').split('\t')
+  return cName, (int(rank), float(conf), path)
+
+def readManifest(manifestFile):
+  """Reads a manifest file written by writeManifest into a poses index"""
+  index = {}
+  with open(manifestFile) as f:
+    f.readline()
+    for line in f:
+      cName, pose = parseManifestLine(line)
+      index.setdefault(cName, []).append(pose)
+  return index
+
+def indexManifest(manifestFile):
+  """Returns the byte offset of the first pose of each complex in a manifest file {complexName: offset}, so the poses
+  of a complex can be read with readManifestPoses without loading the whole manifest"""
+  offsets = {}
+  with open(manifestFile, 'rb') as f:
+    f.readline()
+    offset = f.tell()
+    for line in iter(f.readline, b''):
+      offsets.setdefault(line.split(b'\t', 1)[0].decode(), offset)
+      offset += len(line)
+  return offsets
+
+def readManifestPoses(manifestF, offset, cName):
+  """Reads the consecutive poses of a complex starting at offset of an open manifest file"""
+  poses = []
+  manifestF.seek(offset)
+  for line in iter(manifestF.readline, b''):
+    lineName, pose = parseManifestLine(line.decode())
+    if lineName != cName:
+      break
+    poses.append(pose)
+  return poses
+
+def filterPoses(poses, keepTopK=None, minConfidence=None):
+  """Splits a list of (rank, confidence, path) poses sorted by rank into the ones kept and dropped by the top K
+  and minimum confidence filters. Returns (kept, dropped)"""
+  kept, dropped = [], []
+  for pose in poses:
+    if (keepTopK and len(kept) >= keepTopK) or (minConfidence is not None and pose[1] < minConfidence):
+      dropped.append(pose)
+    else:
+      kept.append(pose)
+  return kept, dropped
+
+def packPoses(poseIndex, packedFile):
+  """Appends the pose sdf files of the index as records of a multi-record sdf file.
+  Returns the index with the pose references to the packed records (packedFile@offset)"""
+  packedIndex = {}
+  with open(packedFile, 'ab') as f:
+    for cName, poses in poseIndex.items():
+      packedIndex[cName] = []
+      for rank, conf, path in poses:
+        with open(path, 'rb') as poseF:
+          record = poseF.read().rstrip()
+        if not record.endswith(b'$$$$'):
+          record += b'\n$$$$'
+        packedIndex[cName].append((rank, conf, f'{packedFile}{PACKED_SEP}{f.tell()}'))
+        f.write(record + b'\n')
+  return packedIndex
+
+def splitPoseReference(poseRef):
+  """Splits a pose reference into its file and record offset. The offset is None for single pose files"""
+  path, sep, offset = poseRef.rpartition(PACKED_SEP)
+  if sep and offset.isdigit():
+    return path, int(offset)
+  return poseRef, None
+
+def appendPoses(outputSet, template, poses, nAppended=0, commitSize=OUTPUT_COMMIT_SIZE):
+  """Appends to an output set the template molecule filled with each (rank, confidence, poseReference) pose, committing
+  the set every commitSize items counted from nAppended. Returns the updated number of appended items"""
+  for rank, conf, poseRef in poses:
+    outFile, offset = splitPoseReference(poseRef)
+    template._energy.set(conf)
+    template.poseFile.set(outFile)
+    if offset is not None:
+      template._poseOffset.set(offset)
+    template.setPoseId(rank)
+
+    template.setObjId(None)
+    outputSet.append(template)
+    nAppended += 1
+    if nAppended % commitSize == 0:
+      outputSet.write()
+  return nAppended
+
+def readPoseRecord(poseRef):
+  """Returns the sdf text of a pose, either a single pose file or a record of a packed file"""
+  path, offset = splitPoseReference(poseRef)
+  with open(path) as f:
+    if offset is None:
+      return f.read()
+    f.seek(offset)
+    lines = []
+    for line in f:
+      lines.append(line)
+      if line.startswith('$$$$'):
+        break
+  return ''.join(lines)
+
+def countHeavyAtoms(smi):
+  """Counts the heavy atoms of a molecule from its SMILES"""
+  return len(SMILES_ATOM_REGEX.findall(smi))
+
+def getAvailableMemory(useGPU=True):
+  """Returns the free memory (MB) of the GPU with less free memory if there are GPUs (and useGPU), or the available
+  RAM otherwise, together with whether it is GPU memory"""
+  try:
+    if not useGPU:
+      raise OSError('GPUs not used')
+    out = subprocess.check_output(['nvidia-smi', '--query-gpu=memory.free', '--format=csv,noheader,nounits'],
+                                  text=True, stderr=subprocess.DEVNULL)
+    return min(float(line) for line in out.split()), True
+  except (OSError, subprocess.CalledProcessError, ValueError):
+    with open('/proc/meminfo') as f:
+      memInfo = dict(line.split(':', 1) for line in f)
+    return float(memInfo['MemAvailable'].split()[0]) / 1024, False
+
+def estimateBatchSize(availableMem, maxHeavyAtoms, nSamples):
+  """Estimates the biggest inference batch size (between 1 and nSamples) fitting in the available memory (MB)"""
+  sampleMem = SAMPLE_BASE_MEM + SAMPLE_ATOM_MEM * maxHeavyAtoms
+  return int(max(1, min(nSamples, availableMem // sampleMem)))
+
+def splitThreads(nThreads, nProcesses):
+  """Returns the number of threads of each of nProcesses processes running at the same time on nThreads cores"""
+  return max(1, nThreads // max(1, nProcesses))
+
+def getThreadsEnviron(nThreads, cpuOnly=False):
+  """Returns the environment variables limiting the threads of the OpenMP, MKL and BLAS libraries of a process to
+  nThreads. If cpuOnly, the GPUs are also hidden from the process"""
+  environ = {var: str(nThreads) for var in THREAD_ENV_VARS}
+  if cpuOnly:
+    environ['CUDA_VISIBLE_DEVICES'] = ''
+  return environ
+
+def getLoggedArgs(args, logFile):
+  """Returns the shell arguments appending the output of a command and its exit code to logFile, so that the exit code
+  is recorded even if the process is killed without writing anything"""
+  return f'{args} >> {logFile} 2>&1; code=$?; echo "{EXIT_CODE_TAG} $code" >> {logFile}; exit $code'
+
+def isOutOfMemoryLog(logFile, offset=0):
+  """Returns whether the log file, from offset on, shows an out of memory failure: an out of memory message, including
+  those of the complexes DiffDock fails on and skips, or the exit code of a process killed by the OOM killer"""
+  if not os.path.exists(logFile):
+    return False
+  with open(logFile, 'rb') as f:
+    f.seek(offset)
+    for line in f:
+      line = line.decode(errors='ignore')
+      if any(message in line for message in OOM_MESSAGES):
+        return True
+      if line.startswith(EXIT_CODE_TAG) and int(line.split()[1]) in OOM_EXIT_CODES:
+        return True
+  return False
+
+def cleanReceptorPDB(pdbFile, outFile):
+  """Writes the atoms of the first model of a pdb structure without waters nor alternative locations other than the
+  first one, which DiffDock does not use"""
+  with open(pdbFile) as f, open(outFile, 'w') as fOut:
+    for line in f:
+      if line.startswith('ENDMDL'):
+        break
+      if line.startswith(('ATOM', 'HETATM')):
+        if line[17:20] in WATER_RESIDUES or line[16] not in ' A1':
+          continue
+        fOut.write(line[:16] + ' ' + line[17:])
+      elif line.startswith('TER'):
+        fOut.write(line)
+    fOut.write('END\n')
+
+def cropStructure(pdbFile, center, radius, outFile):
+  """Writes the residues of a pdb structure with any atom closer than radius to center. Whole residues are kept,
+  and the coordinates are not modified so the cropped structure shares the frame of the original"""
+  residueLines, closeResidues = {}, set()
+  with open(pdbFile) as f:
+    for line in f:
+      if line.startswith(('ATOM', 'HETATM')):
+        resKey = (line[21], line[22:27])
+        residueLines.setdefault(resKey, []).append(line)
+        coords = float(line[30:38]), float(line[38:46]), float(line[46:54])
+        if sum((c - cc) ** 2 for c, cc in zip(coords, center)) <= radius ** 2:
+          closeResidues.add(resKey)
+
+  with open(outFile, 'w') as f:
+    for resKey, lines in residueLines.items():
+      if resKey in closeResidues:
+        f.writelines(lines)
+    f.write('END\n')
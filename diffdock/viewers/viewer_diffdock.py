@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Viewer of the DiffDock docking results. The docked complexes are browsed by pages and plotted from the pose summary
+precomputed by the protocol, so only the poses of the complex being visualized are read.
+"""
+
+import os
+
+from pyworkflow.protocol import params
+from pyworkflow.viewer import ProtocolViewer, DESKTOP_TKINTER, View
+from pyworkflow.gui.text import openTextFileEditor
+from pwem.viewers import EmPlotter
+
+from pwchem.viewers import PyMolView
+
+from ..protocols import ProtDiffDockDocking
+from ..utils import PoseSummary, SUMMARY_ORDERS, readManifestPoses, readPoseRecord
+
+NO_SUMMARY_MESSAGE = 'The pose summary of the protocol was not found. Is the docking finished?'
+
+
+class TextFileView(View):
+  '''Shows a text file in the Scipion text viewer'''
+  def __init__(self, fileName):
+    self.fileName = fileName
+
+  def show(self):
+    openTextFileEditor(self.fileName)
+
+
+class DiffDockViewer(ProtocolViewer):
+  '''Browses the complexes docked by DiffDock by pages, plots their confidence distributions and shows the poses
+  of a single complex with its receptor'''
+  _label = 'DiffDock results viewer'
+  _targets = [ProtDiffDockDocking]
+  _environments = [DESKTOP_TKINTER]
+
+  def _defineParams(self, form):
+    form.addSection(label='Results')
+    group = form.addGroup('Complexes')
+    group.addParam('orderBy', params.EnumParam, label='Sort complexes by: ', default=0,
+                   choices=['Best confidence', 'Mean confidence', 'Number of poses', 'Name'],
+                   help='Order of the complexes in the pages')
+    group.addParam('pageSize', params.IntParam, label='Complexes per page: ', default=100)
+    group.addParam('page', params.IntParam, label='Page: ', default=1,
+                   help='Page of the sorted complexes to display. Only the rows of this page are read')
+    group.addParam('displayPage', params.LabelParam, label='Display page of complexes: ',
+                   help='Shows the rank, number of poses and confidence statistics of the complexes of the page')
+
+    group = form.addGroup('Poses')
+    group.addParam('complexPosition', params.IntParam, label='Complex position: ', default=1,
+                   help='Position of the complex in the sorted complexes (as displayed in the pages)')
+    group.addParam('displayPoses', params.LabelParam, label='Display complex poses in PyMol: ',
+                   help='Shows the receptor and the poses of the complex. Only the poses of this complex are read')
+
+    group = form.addGroup('Confidence')
+    group.addParam('displayBestHist', params.LabelParam, label='Best pose confidence histogram: ',
+                   help='Histogram of the confidence of the best pose of each complex')
+    group.addParam('displayAllHist', params.LabelParam, label='All poses confidence histogram: ',
+                   help='Histogram of the confidence of all the output poses')
+
+  def _getVisualizeDict(self):
+    return {
+      'displayPage': self._showPage,
+      'displayPoses': self._showPoses,
+      'displayBestHist': lambda paramName: self._showHistogram('best'),
+      'displayAllHist': lambda paramName: self._showHistogram('all'),
+    }
+
+  def getOrder(self):
+    return list(SUMMARY_ORDERS)[self.orderBy.get()]
+
+  def getViewerPath(self, fileName):
+    '''Returns the path of a file written by the viewer in the protocol tmp directory, as the subdirectories of the
+    extra directory are the complex outputs'''
+    viewerDir = self.protocol._getTmpPath('viewer')
+    os.makedirs(viewerDir, exist_ok=True)
+    return os.path.abspath(os.path.join(viewerDir, fileName))
+
+  def getSummary(self):
+    summaryFile = self.protocol.getSummaryFile()
+    return PoseSummary(summaryFile) if os.path.exists(summaryFile) else None
+
+  def _showPage(self, paramName=None):
+    summary = self.getSummary()
+    if summary is None:
+      return [self.errorMessage(NO_SUMMARY_MESSAGE)]
+    pageSize = max(1, self.pageSize.get())
+    nPages = max(1, -(-summary.count() // pageSize))
+    page = min(max(1, self.page.get()), nPages)
+    rows = summary.getPage(page, pageSize, self.getOrder())
+
+    pageFile = self.getViewerPath('summaryPage.tsv')
+    with open(pageFile, 'w') as f:
+      f.write(f'# Page {page} of {nPages}\n')
+      f.write('position\tcomplex\tnPoses\tbestConfidence\tmeanConfidence\tconfidenceStd\tconfidenceRange\n')
+      for i, row in enumerate(rows, start=(page - 1) * pageSize + 1):
+        f.write(f'{i}\t{row["complex"]}\t{row["nPoses"]}\t{row["bestConfidence"]:.3f}\t'
+                f'{row["meanConfidence"]:.3f}\t{row["confidenceStd"]:.3f}\t{row["confidenceRange"]:.3f}\n')
+    return [TextFileView(pageFile)]
+
+  def _showPoses(self, paramName=None):
+    summary = self.getSummary()
+    if summary is None:
+      return [self.errorMessage(NO_SUMMARY_MESSAGE)]
+    rows = summary.getPage(max(1, self.complexPosition.get()), 1, self.getOrder())
+    if not rows:
+      return [self.errorMessage(f'There are only {summary.count()} docked complexes')]
+
+    cName = rows[0]['complex']
+    with open(self.protocol.getManifestFile(), 'rb') as f:
+      poses = readManifestPoses(f, rows[0]['manifestOffset'], cName)
+    posesFile = self.getViewerPath(f'{cName}_poses.sdf')
+    with open(posesFile, 'w') as f:
+      for rank, conf, poseRef in poses:
+        record = readPoseRecord(poseRef).split('\n', 1)
+        f.write(f'rank{rank}_confidence{conf:.2f}\n{record[1] if len(record) > 1 else ""}')
+
+    pmlFile = self.getViewerPath(f'{cName}_poses.pml')
+    with open(pmlFile, 'w') as f:
+      f.write(f'load {os.path.abspath(self.protocol.getComplexReceptorFile(cName))}, receptor\n'
+              f'hide everything, receptor\nshow cartoon, receptor\n'
+              f'load {posesFile}, poses, multiplex=1\nzoom rank*\n')
+    return [PyMolView(pmlFile, cwd=os.path.dirname(pmlFile))]
+
+  def _showHistogram(self, kind):
+    summary = self.getSummary()
+    if summary is None:
+      return [self.errorMessage(NO_SUMMARY_MESSAGE)]
+    bins = summary.getHistogram(kind)
+    title = 'Best pose confidence of each complex' if kind == 'best' else 'Confidence of all the poses'
+    plotter = EmPlotter(x=1, y=1, windowTitle='DiffDock confidence')
+    ax = plotter.createSubPlot(title, 'Confidence', 'Complexes' if kind == 'best' else 'Poses')
+    ax.bar([lower for lower, _, _ in bins], [count for _, _, count in bins],
+           width=[upper - lower for lower, upper, _ in bins], align='edge', edgecolor='black')
+    return [plotter]